@@ -0,0 +1,111 @@
+"""
+Local per-month cache of chess.com archive JSON.
+
+Finished months never change on chess.com, so once a month has been fetched after it ended it is served
+straight from disk. Everything else is revalidated with a conditional request (ETag / Last-Modified).
+"""
+
+import datetime
+import json
+import os
+import profiling
+
+DEFAULT_CACHE_DIR = '.gamegrab_cache'
+CHUNK_SIZE = 1 << 16
+
+# Late-finishing games can show up in an archive shortly after the month ends
+ARCHIVE_GRACE = datetime.timedelta(days=1)
+
+
+def month_of(url):
+    year, month = map(int, url.split('/')[-2:])
+    return year, month
+
+def month_end(year, month):
+    if month == 12:
+        return datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc)
+    return datetime.datetime(year, month + 1, 1, tzinfo=datetime.timezone.utc)
+
+def current_month():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.year, now.month
+
+def month_is_final(url, when):
+    """True if the monthly archive at url could no longer change after when (an aware datetime)."""
+    return when >= month_end(*month_of(url)) + ARCHIVE_GRACE
+
+def write_atomic(path, data):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ArchiveCache:
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = root
+
+    def paths(self, url):
+        # .../pub/player/{user}/games/archives or .../pub/player/{user}/games/{YYYY}/{MM}
+        parts = url.rstrip('/').split('/')
+        if parts[-1] == 'archives':
+            user, name = parts[-3], 'archives'
+        else:
+            user, name = parts[-4], f'{parts[-2]}-{parts[-1]}'
+        directory = os.path.join(self.root, user.lower())
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f'{name}.json'), os.path.join(directory, f'{name}.meta.json')
+
+    def load_meta(self, meta_path):
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def is_final(self, url, meta, data_path):
+        if url.endswith('/archives'):
+            # The archive list only grows when a new month starts
+            with open(data_path) as f:
+                return current_month() in map(month_of, json.load(f)['archives'])
+        return month_is_final(url, datetime.datetime.fromisoformat(meta['fetched']))
+
+    def fetch(self, session, url):
+        """Returns the path of the cached JSON body for url, making a conditional request unless the cached copy is final."""
+        data_path, meta_path = self.paths(url)
+        meta = self.load_meta(meta_path)
+        if meta and not os.path.exists(data_path):
+            meta = None
+
+        if meta and self.is_final(url, meta, data_path):
+            profiling.add('archive cache hits')
+            return data_path
+
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        with profiling.stage('download', url=url), session.get(url, headers=headers, stream=True) as response:
+            if response.status_code != 304 or not meta:
+                response.raise_for_status()
+                profiling.add('archive cache misses')
+                # Stream the body to disk so large months are never held in memory
+                tmp = f'{data_path}.tmp'
+                with open(tmp, 'wb') as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        profiling.add('bytes fetched', len(chunk))
+                os.replace(tmp, data_path)
+                meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            else:
+                # Not modified: revalidated, so it still counts as served from the cache
+                profiling.add('archive cache hits')
+
+        meta['fetched'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        write_atomic(meta_path, json.dumps(meta).encode())
+        return data_path
+
+    def get(self, session, url):
+        with open(self.fetch(session, url), 'rb') as f:
+            return f.read()
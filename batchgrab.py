@@ -0,0 +1,189 @@
+"""batchgrab
+
+Download the games of many users at once, writing one PGN per user.
+
+Usage:
+  batchgrab.py [--time-class=TC] [--color=COLOR] [--since=YYYYMM] [--outdir=DIR] [--concurrency=N] [--rate=R] [--cache-dir=DIR] [--base-url=URL] [--users-file=FILE] [--suffix=SUFFIX] [--profile] [--trace=FILE] [USERNAME...]
+  batchgrab.py (-h | --help)
+
+Options:
+  --time-class=TC       Only download games of specified time control.
+  --color=COLOR         Download games of specific color.
+  --since=YYYYMM        Only download games on or after given year and month.
+  --outdir=DIR          Directory for the USERNAME.pgn files [default: .]
+  --concurrency=N       Requests in flight at once across all users [default: 8]
+  --rate=R              Requests started per second across all users [default: 10]
+  --cache-dir=DIR       Cache monthly archives in DIR and only re-request months that may have changed.
+  --base-url=URL        Use another chess.com API host, e.g. a local mockchesscom.py server.
+  --users-file=FILE     Read more usernames from FILE, one per line.
+  --suffix=SUFFIX       Output file suffix; .pgn.gz and .pgn.zst are compressed [default: .pgn]
+  --profile             Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE          Also write a Chrome trace event JSON of the run to FILE.
+  -h --help             Show this screen.
+
+Arguments:
+  USERNAME      usernames to download games for
+"""
+
+from archivecache import ArchiveCache
+from collections import deque
+from docopt import docopt
+from email.utils import parsedate_to_datetime
+
+import asyncio
+import datetime
+import gamegrab
+import itertools
+import os
+import pgnio
+import profiling
+import random
+import requests
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 10
+MAX_ATTEMPTS = 6
+# First backoff when a 429 or 5xx comes without Retry-After, doubled on every further attempt
+BACKOFF = 1.0
+
+
+class RequestBudget:
+    """Global limit on requests in flight and requests started per second, shared by every user's downloads.
+
+    A 429 pauses new requests for everyone, since the server's limit is per client rather than per user.
+    """
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.interval = 1 / rate
+        self.next_start = 0.0
+        self.resume_at = 0.0
+        self.requests, self.retries = 0, 0
+
+    async def __aenter__(self):
+        await self.slots.acquire()
+        loop = asyncio.get_running_loop()
+        while (start := max(self.next_start, self.resume_at)) > loop.time():
+            await asyncio.sleep(start - loop.time())
+        self.next_start = loop.time() + self.interval
+        self.requests += 1
+
+    async def __aexit__(self, *exc):
+        self.slots.release()
+
+    def backoff(self, delay):
+        self.retries += 1
+        self.resume_at = max(self.resume_at, asyncio.get_running_loop().time() + delay)
+
+
+def retry_after(response):
+    """Seconds to wait from a Retry-After header (seconds or an HTTP date), or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+async def call(budget, fetch, *args):
+    """Runs a blocking gamegrab fetch in a thread within the budget, retrying 429s and server errors."""
+    for attempt in range(MAX_ATTEMPTS):
+        async with budget:
+            try:
+                return await asyncio.to_thread(fetch, *args)
+            except requests.HTTPError as e:
+                status = e.response.status_code
+                if (status != 429 and status < 500) or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                delay = retry_after(e.response)
+                if delay is None:
+                    delay = BACKOFF * 2 ** attempt * (1 + random.random())
+        budget.backoff(delay)
+
+def write_month(f, body, wanted):
+    n = 0
+    for pgn in gamegrab.iter_matches_reversed(body, wanted):
+        f.write(pgn)
+        f.write('\n')
+        n += 1
+    return n
+
+async def grab_user(session, budget, user, outfile, wanted, since=None, cache=None, base_url=gamegrab.API_URL, window=DEFAULT_CONCURRENCY):
+    """Downloads one user's games newest-first into outfile and returns the number of games written."""
+    urls = await call(budget, gamegrab.fetch_json, session, gamegrab.archives_url(user, base_url), cache)
+    archives = iter(gamegrab.select_archives(urls['archives'], since))
+    # Up to `window` months download ahead within the budget, but they are written in order
+    pending = deque()
+    def prefetch():
+        for url in itertools.islice(archives, window - len(pending)):
+            pending.append(asyncio.ensure_future(call(budget, gamegrab.fetch_body, session, url, cache)))
+
+    game_ctr = 0
+    tmp = f'{outfile}.tmp'
+    try:
+        with pgnio.open_pgn(tmp, 'w', pgnio.compression_of(outfile)) as f:
+            prefetch()
+            while pending:
+                body = await pending.popleft()
+                prefetch()
+                game_ctr += await asyncio.to_thread(write_month, f, body, wanted)
+        os.replace(tmp, outfile)
+    finally:
+        for month in pending:
+            if not month.cancel():
+                gamegrab.close_result(month)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return game_ctr
+
+async def grab_all(users, outdir='.', time_class=None, color=None, since=None, concurrency=DEFAULT_CONCURRENCY,
+                   rate=DEFAULT_RATE, cache=None, base_url=gamegrab.API_URL, suffix='.pgn'):
+    """Downloads every user concurrently. Returns {user: games written or the exception that stopped it}."""
+    session = gamegrab.make_session(concurrency)
+    budget = RequestBudget(concurrency, rate)
+    os.makedirs(outdir, exist_ok=True)
+
+    async def grab(user):
+        outfile = os.path.join(outdir, f'{user}{suffix}')
+        try:
+            n = await grab_user(session, budget, user, outfile, gamegrab.game_filter(user, time_class, color), since, cache, base_url)
+        except Exception as e:
+            print(f'{user}: failed ({e})', flush=True)
+            return e
+        print(f'{user}: {n} games -> {outfile}', flush=True)
+        return n
+
+    results = await asyncio.gather(*(grab(user) for user in users))
+    print(f'{budget.requests} requests, {budget.retries} retried.')
+    return dict(zip(users, results))
+
+def main(arguments):
+    users = list(arguments.get('USERNAME') or [])
+    if arguments.get('--users-file'):
+        with open(arguments['--users-file']) as f:
+            users += [line.strip() for line in f if line.strip()]
+    # chess.com usernames are case-insensitive
+    unique = {}
+    for user in users:
+        unique.setdefault(user.lower(), user)
+    users = list(unique.values())
+
+    return asyncio.run(grab_all(
+        users,
+        outdir=arguments.get('--outdir') or '.',
+        time_class=arguments.get('--time-class'),
+        color=arguments['--color'].lower() if arguments.get('--color') else None,
+        since=arguments.get('--since'),
+        concurrency=int(arguments.get('--concurrency') or DEFAULT_CONCURRENCY),
+        rate=float(arguments.get('--rate') or DEFAULT_RATE),
+        cache=ArchiveCache(arguments['--cache-dir']) if arguments.get('--cache-dir') else None,
+        base_url=arguments.get('--base-url') or gamegrab.API_URL,
+        suffix=arguments.get('--suffix') or '.pgn',
+    ))
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    with profiling.session(arguments):
+        main(arguments)
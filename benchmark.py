@@ -0,0 +1,251 @@
+"""benchmark
+
+Times the hot paths on a synthetic corpus: archive download from a local mock chess.com server, PGN parsing and
+scanning, indexing, think-time and scramble detection, the rolling rating average and engine evaluation.
+
+Usage:
+  benchmark.py [--games=N] [--seed=SEED] [--workdir=DIR] [--stages=STAGES] [--read-games=N] [--download-games=N] [--positions=N] [--engines=N] [--depth=D] [--json=FILE] [--compare=FILE]
+  benchmark.py (-h | --help)
+
+Options:
+  --games=N            Games in the synthetic corpus [default: 10000]
+  --seed=SEED          Seed for the corpus [default: 0]
+  --workdir=DIR        Where the corpus and outputs are written [default: .benchmark]
+  --stages=STAGES      Comma-separated stages to run [default: generate,download,read_game,scan,index,think_times,scramble,graph,engine]
+  --read-games=N       Games parsed in the read_game stage, which is much slower than the others [default: 2000]
+  --download-games=N   Games served by the mock chess.com API in the download stage [default: 5000]
+  --positions=N        Positions evaluated by fakeuci.py engines in the engine stage [default: 500]
+  --engines=N          Engine processes in the engine stage [default: 2]
+  --depth=D            Search depth in the engine stage [default: 10]
+  --json=FILE          Save the results to FILE.
+  --compare=FILE       Show speedups against results saved by an earlier run.
+  -h --help            Show this screen.
+
+Every stage runs in a fresh process, so the peak RSS reported is that stage's own. The think_times and scramble
+stages include scanning the corpus; subtract the scan stage to get the detectors alone.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from docopt import docopt
+from mockchesscom import clock_str
+
+import chess
+import chess.engine
+import chess.pgn
+import datetime
+import enginepool
+import gamegrab
+import itertools
+import json
+import mockchesscom
+import multiprocessing
+import naroditsky
+import os
+import pgnio
+import random
+import records
+import resource
+import sys
+import time
+import timestats
+
+USERNAME = 'bench'
+TIME_CONTROLS = ('60', '60', '120+1', '180', '180+2', '300')
+THINK_TIMES = (1, 1, 2, 3, 5, 8, 10, 15, 20, 30, 50, 100, 200)
+LINE_POOL = 256
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeuci.py')
+STAGE_NAMES = ('generate', 'download', 'read_game', 'scan', 'index', 'think_times', 'scramble', 'graph', 'engine')
+
+
+def random_lines(rng, n):
+    """n random legal games as SAN lists. Games in the corpus replay prefixes of these, which is far cheaper
+    than generating legal moves for every game."""
+    lines = []
+    for _ in range(n):
+        board, line = chess.Board(), []
+        while len(line) < 160 and not board.is_game_over():
+            move = rng.choice(list(board.legal_moves))
+            line.append(board.san(move))
+            board.push(move)
+        lines.append(line)
+    return lines
+
+def game_text(rng, line, index, when, rating):
+    time_control = rng.choice(TIME_CONTROLS)
+    base, _, inc = time_control.partition('+')
+    clocks = [int(base) * 10] * 2
+    opp_rating = rating + rng.randint(-200, 200)
+    user_is_white = rng.random() < 0.5
+    result = rng.choice(('1-0', '0-1', '1/2-1/2'))
+    headers = {
+        'Event': 'Live Chess', 'Site': 'Chess.com', 'Date': when.strftime('%Y.%m.%d'), 'Round': '-',
+        'White': USERNAME if user_is_white else f'opponent{rng.randint(1, 5000)}',
+        'Black': f'opponent{rng.randint(1, 5000)}' if user_is_white else USERNAME,
+        'Result': result, 'ECO': rng.choice(('A00', 'B20', 'B90', 'C50', 'C65', 'D02', 'E60')),
+        'UTCDate': when.strftime('%Y.%m.%d'), 'UTCTime': when.strftime('%H:%M:%S'),
+        'WhiteElo': str(rating if user_is_white else opp_rating), 'BlackElo': str(opp_rating if user_is_white else rating),
+        'TimeControl': time_control, 'Termination': f'{USERNAME} won on time',
+        'Link': f'https://www.chess.com/game/live/{100000000 + index}',
+    }
+    moves = []
+    for ply, san in enumerate(line[:rng.randint(20, len(line))] if len(line) > 20 else line):
+        side = ply % 2
+        clocks[side] = max(0, clocks[side] - rng.choice(THINK_TIMES)) + int(inc or 0) * 10
+        moves.append(f'{ply // 2 + 1}{"." if side == 0 else "..."} {san} {{[%clk {clock_str(clocks[side])}]}}')
+    return ''.join(f'[{name} "{value}"]\n' for name, value in headers.items()) + '\n' + ' '.join(moves) + f' {result}\n\n'
+
+def generate_pgn(pgnfile, games, seed=0):
+    """Writes a deterministic corpus of bullet and blitz games with %clk comments, oldest first."""
+    rng = random.Random(seed)
+    lines = random_lines(rng, LINE_POOL)
+    when = datetime.datetime(2020, 1, 1)
+    # Spread the games over about three years
+    mean_gap = 3 * 365 * 24 * 3600 / games
+    rating = 1500
+    tmp = f'{pgnfile}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for index in range(games):
+            when += datetime.timedelta(seconds=rng.expovariate(1 / mean_gap))
+            rating = max(100, rating + rng.randint(-8, 8))
+            f.write(game_text(rng, rng.choice(lines), index, when, rating))
+    os.replace(tmp, pgnfile)
+    return games
+
+
+# Each stage returns (games, bytes processed or 0, seconds), timing only its hot loop
+
+def bench_generate(options):
+    start = time.perf_counter()
+    games = generate_pgn(options['corpus'], options['games'], options['seed'])
+    return games, os.path.getsize(options['corpus']), time.perf_counter() - start
+
+def bench_download(options):
+    months = 12
+    per_month = -(-options['download_games'] // months)
+    server = mockchesscom.serve(months=months, games=per_month)
+    # Build the synthetic months up front so only the download itself is timed
+    for year, month in mockchesscom.recent_months(months):
+        mockchesscom.month_archive(USERNAME, year, month, per_month, 0)
+    outfile = os.path.join(options['workdir'], 'download.pgn')
+    start = time.perf_counter()
+    gamegrab.main({'USERNAME': USERNAME, '--outfile': outfile, '--base-url': server.url})
+    seconds = time.perf_counter() - start
+    server.shutdown()
+    return sum(1 for _ in pgnio.scan_pgn(outfile)), os.path.getsize(outfile), seconds
+
+def bench_read_game(options):
+    games = 0
+    with pgnio.open_pgn(options['corpus']) as f:
+        start = time.perf_counter()
+        while games < options['read_games'] and chess.pgn.read_game(f):
+            games += 1
+        return games, f.tell(), time.perf_counter() - start
+
+def bench_scan(options):
+    start = time.perf_counter()
+    games = sum(1 for _ in pgnio.scan_pgn(options['corpus']))
+    return games, os.path.getsize(options['corpus']), time.perf_counter() - start
+
+def bench_index(options):
+    if os.path.exists(pgnio.index_path(options['corpus'])):
+        os.remove(pgnio.index_path(options['corpus']))
+    start = time.perf_counter()
+    games = len(pgnio.update_index(options['corpus']))
+    return games, os.path.getsize(options['corpus']), time.perf_counter() - start
+
+def bench_think_times(options):
+    games = 0
+    start = time.perf_counter()
+    for game in pgnio.scan_pgn(options['corpus']):
+        timestats.get_think_times(game, USERNAME)
+        games += 1
+    return games, os.path.getsize(options['corpus']), time.perf_counter() - start
+
+def bench_scramble(options):
+    games = 0
+    start = time.perf_counter()
+    for game in pgnio.scan_pgn(options['corpus']):
+        timestats.was_time_scramble(game)
+        naroditsky.was_time_scramble(game)
+        games += 1
+    return games, os.path.getsize(options['corpus']), time.perf_counter() - start
+
+def bench_graph(options):
+    # pandas is only imported here so it does not count towards the other stages' memory
+    import graph
+    games = records.GameRecords.from_games(pgnio.index_games(options['corpus']), USERNAME)
+    start = time.perf_counter()
+    graph.rating_history(games, 500)
+    return len(games), 0, time.perf_counter() - start
+
+def bench_engine(options):
+    with pgnio.open_pgn(options['corpus']) as f:
+        games = (game for game in pgnio.read_plies(f, (40,)) if 40 in game.boards)
+        boards = [(i, game.boards[40]) for i, game in enumerate(itertools.islice(games, options['positions']))]
+    with enginepool.EnginePool([sys.executable, FAKE_ENGINE], options['engines']) as pool:
+        start = time.perf_counter()
+        evaluated = sum(1 for _ in pool.analyse(boards, chess.engine.Limit(depth=options['depth'])))
+        return evaluated, 0, time.perf_counter() - start
+
+STAGES = {name: globals()[f'bench_{name}'] for name in STAGE_NAMES}
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def run_stage(name, options):
+    games, size, seconds = STAGES[name](options)
+    return {'games': games, 'bytes': size, 'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+
+def print_results(results, baseline=None):
+    print(f'{"stage":<12} {"games":>9} {"seconds":>9} {"games/s":>11} {"MB/s":>8} {"peak RSS MB":>12}' + ('  speedup' if baseline else ''))
+    for name, r in results.items():
+        rate = r['games'] / r['seconds'] if r['seconds'] else float('inf')
+        mb_per_sec = f'{r["bytes"] / r["seconds"] / 1e6:8.1f}' if r['bytes'] and r['seconds'] else f'{"-":>8}'
+        line = f'{name:<12} {r["games"]:>9} {r["seconds"]:>9.3f} {rate:>11.1f} {mb_per_sec} {r["peak_rss_mb"]:>12.1f}'
+        if baseline and name in baseline and baseline[name]['games']:
+            old_rate = baseline[name]['games'] / baseline[name]['seconds']
+            line += f'  {rate / old_rate:6.2f}x'
+        print(line, flush=True)
+
+def main(arguments):
+    workdir = arguments['--workdir']
+    games = int(arguments['--games'])
+    seed = int(arguments['--seed'])
+    options = {
+        'workdir': workdir, 'games': games, 'seed': seed,
+        'corpus': os.path.join(workdir, f'corpus_{games}_{seed}.pgn'),
+        'read_games': int(arguments['--read-games']), 'download_games': int(arguments['--download-games']),
+        'positions': int(arguments['--positions']), 'engines': int(arguments['--engines']), 'depth': int(arguments['--depth']),
+    }
+    stages = [name.strip() for name in arguments['--stages'].split(',') if name.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        sys.exit(f'Unknown stages: {", ".join(sorted(unknown))}. Choose from {", ".join(STAGE_NAMES)}.')
+
+    os.makedirs(workdir, exist_ok=True)
+    if 'generate' not in stages and not os.path.exists(options['corpus']):
+        print(f'Generating {options["corpus"]}...', flush=True)
+        generate_pgn(options['corpus'], games, seed)
+
+    results = {}
+    spawn = multiprocessing.get_context('spawn')
+    for name in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+            results[name] = executor.submit(run_stage, name, options).result()
+
+    baseline = None
+    if arguments.get('--compare'):
+        with open(arguments['--compare']) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if arguments.get('--json'):
+        with open(arguments['--json'], 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2)
+    return results
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    main(arguments)
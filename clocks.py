@@ -0,0 +1,196 @@
+"""
+Fast clock extraction straight from PGN text.
+
+Reads headers and %clk comments from raw movetext without building python-chess boards or game trees,
+which is all the think-time analyses need. ClockTimeline turns a game's clocks into think times and scramble checks.
+"""
+
+from array import array
+import numpy as np
+import re
+
+HEADER_REGEX = re.compile(r'\[(\w+) "(.*)"\]')
+CLOCK_REGEX = re.compile(r'%clk (\d+):(\d+):(\d+)(?:\.(\d))?')
+# A move (or result) with the comments and NAGs after it, or a move number, comment or NAG that follows no move,
+# for movetext without variations
+MOVE_REGEX = re.compile(r'\d+\.+\s*|\{[^}]*\}\s*|\$\d+\s*|([^\s{}()$]+)\s*((?:\{[^}]*\}\s*|\$\d+\s*)*)')
+# Comments, variation brackets, NAGs and everything else, for movetext with variations
+TOKEN_REGEX = re.compile(r'(\{[^}]*\})|([()])|\$\d+|([^\s{}()$]+)')
+MOVE_NUMBER_REGEX = re.compile(r'^\d+\.+')
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+# Base time with an optional increment; daily ('1/259200') and unknown ('-') time controls have no starting clock
+TIME_CONTROL_REGEX = re.compile(r'(\d+)(?:\+\d+)?')
+
+
+def mainline(movetext):
+    """(san, text of the comments after it) for each mainline move, skipping variations (nested or not) and NAGs."""
+    if '(' not in movetext:
+        tokens = MOVE_REGEX.findall(movetext)
+    else:
+        tokens, depth = [], 0
+        for comment, bracket, token in TOKEN_REGEX.findall(movetext):
+            if bracket:
+                depth += 1 if bracket == '(' else -1
+            elif depth > 0:
+                continue
+            elif token:
+                tokens.append((token, ''))
+            elif tokens:
+                tokens[-1] = (tokens[-1][0], tokens[-1][1] + comment)
+    moves = []
+    for token, comments in tokens:
+        if token[:1].isdigit():
+            token = MOVE_NUMBER_REGEX.sub('', token)
+        if token and token not in RESULTS:
+            moves.append((token, comments))
+    return moves
+
+def parse_clocks(movetext):
+    """Clock after each mainline ply in tenths of a second, -1 for a ply without a %clk comment."""
+    return array('i', (parse_clock(comments) if comments else -1 for san, comments in mainline(movetext)))
+
+def parse_clock(comment):
+    """Clock in a single move comment in tenths of a second, or -1 if there is none."""
+    match = CLOCK_REGEX.search(comment)
+    if not match:
+        return -1
+    h, m, sec, d = match.groups()
+    return int(h) * 36000 + int(m) * 600 + int(sec) * 10 + int(d or 0)
+
+def parse_moves(movetext):
+    """SAN moves of the mainline, taken from the movetext without checking legality."""
+    return [san for san, comments in mainline(movetext)]
+
+
+class ScannedGame:
+    """Headers and clocks of one game. Has the same offset/headers/clocks/plies interface as gamestore.StoredGame."""
+    __slots__ = ('offset', 'length', 'headers', 'movetext', 'clocks')
+
+    def __init__(self, offset, length, headers, movetext):
+        self.offset = offset
+        self.length = length
+        self.headers = headers
+        self.movetext = movetext
+        self.clocks = parse_clocks(movetext)
+
+    @property
+    def white_first(self):
+        return ' b ' not in self.headers.get('FEN', ' w ')
+
+    @property
+    def plies(self):
+        return len(self.clocks)
+
+    def moves(self):
+        return parse_moves(self.movetext)
+
+
+class ClockTimeline:
+    """Both players' clocks through one game in tenths of a second, shared by the think-time and scramble detectors.
+
+    clocks[ply] is the mover's clock after that ply, or -1 for a ply without a %clk comment.
+    """
+    __slots__ = ('start', 'clocks', 'white_first')
+
+    def __init__(self, clocks, start, white_first=True):
+        self.clocks = clocks
+        self.start = start
+        self.white_first = white_first
+
+    @classmethod
+    def from_game(cls, game):
+        """Builds the timeline of a ScannedGame, gamestore.StoredGame or chess.pgn.Game in one pass."""
+        headers = game.headers
+        match = TIME_CONTROL_REGEX.fullmatch(headers.get('TimeControl', '-'))
+        start = int(match.group(1)) * 10 if match else -1
+        white_first = ' b ' not in headers.get('FEN', ' w ')
+        clocks = getattr(game, 'clocks', None)
+        if clocks is None:
+            clocks = array('i', (parse_clock(node.comment) for node in game.mainline()))
+        return cls(clocks, start, white_first)
+
+    def __len__(self):
+        return len(self.clocks)
+
+    def is_white(self, ply):
+        return (ply % 2 == 0) == self.white_first
+
+    def think_times(self, white):
+        """(ply, time spent) for each move by one side. Increments make a quick move's time negative."""
+        prev = self.start
+        for ply, clock in enumerate(self.clocks):
+            if self.is_white(ply) == white and clock >= 0:
+                yield ply, prev - clock
+                prev = clock
+
+    def long_thinks(self, white, threshold):
+        return [(ply, delta) for ply, delta in self.think_times(white) if delta >= threshold]
+
+    def scramble_think_times(self, white, limit=100):
+        """Time spent on each move made with both clocks under limit."""
+        times = array('i')
+        opp = self.start
+        prev = self.start
+        for ply, clock in enumerate(self.clocks):
+            if clock < 0:
+                continue
+            if self.is_white(ply) == white:
+                if clock < limit and opp < limit:
+                    times.append(prev - clock)
+                prev = clock
+            else:
+                opp = clock
+        return times
+
+    def scramble_pairs(self, limit):
+        """Number of non-overlapping pairs of consecutive clocks under limit."""
+        pairs, run = 0, 0
+        for clock in self.clocks:
+            if clock < 0:
+                continue
+            if clock < limit:
+                run += 1
+            else:
+                pairs, run = pairs + run // 2, 0
+        return pairs + run // 2
+
+    def was_scramble(self, limit, min_pairs=5):
+        return self.scramble_pairs(limit) >= min_pairs
+
+    def states(self, white):
+        """(own clocks, opponent clocks) at the start and after every ply as int64 arrays, carrying each clock forward."""
+        times = np.asarray(self.clocks, dtype=np.int64)
+        plies = np.arange(len(times))
+        own_moved = ((plies % 2 == 0) == self.white_first) == white
+
+        states = []
+        for moved in (own_moved, ~own_moved):
+            # Carry each side's last clock forward through the other side's moves and its own moves without a clock
+            last = np.maximum.accumulate(np.where(moved & (times >= 0), plies, -1))
+            side_times = np.where(last >= 0, times[np.maximum(last, 0)], self.start)
+            states.append(np.concatenate(([self.start], side_times)))
+        return states
+
+
+def scan_games(f, end=None):
+    """Yields a ScannedGame for every game in a PGN file opened in binary mode, stopping at byte offset end."""
+    offset = f.tell()
+    start, headers, movetext = offset, {}, []
+    for line in f:
+        if end is not None and offset >= end:
+            break
+        stripped = line.strip()
+        match = HEADER_REGEX.fullmatch(stripped.decode('utf-8', 'replace')) if stripped.startswith(b'[') else None
+        if match:
+            if movetext:
+                # Headers after movetext start the next game
+                yield ScannedGame(start, offset - start, headers, ' '.join(movetext))
+                headers, movetext = {}, []
+            if not headers:
+                start = offset
+            headers[match.group(1)] = match.group(2)
+        elif stripped:
+            movetext.append(stripped.decode('utf-8', 'replace'))
+        offset += len(line)
+    if headers or movetext:
+        yield ScannedGame(start, offset - start, headers, ' '.join(movetext))
@@ -0,0 +1,165 @@
+"""
+Pool of UCI engine processes for analysing a stream of positions in parallel.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from queue import Queue
+import chess.engine
+import os
+import profiling
+import time
+
+# Override with the STOCKFISH environment variable or the scripts' --engine option
+DEFAULT_ENGINE = os.environ.get('STOCKFISH', 'stockfish')
+# Each extra ply costs an alpha-beta engine about this many times more time
+BRANCHING = 1.8
+
+
+class EnginePool:
+    def __init__(self, path=DEFAULT_ENGINE, engines=1, threads=1, hash_mb=16, cache=None):
+        """cache is an optional evalcache.EvalCache, closed together with the pool."""
+        self.cache = cache
+        self.engines = []
+        self.idle = Queue()
+        for _ in range(engines):
+            engine = chess.engine.SimpleEngine.popen_uci(path)
+            engine.configure({'Threads': threads, 'Hash': hash_mb})
+            self.engines.append(engine)
+            self.idle.put(engine)
+        self.executor = ThreadPoolExecutor(max_workers=engines)
+        # Cached evaluations are only shared between identically configured engines
+        self.key = f"{self.engines[0].id.get('name', path)} Threads={threads} Hash={hash_mb}"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        for engine in self.engines:
+            engine.quit()
+        if self.cache:
+            self.cache.close()
+
+    def _analyse(self, game_id, board, limit):
+        engine = self.idle.get()
+        try:
+            with profiling.stage('engine search'):
+                start = time.perf_counter()
+                info = engine.analyse(board, limit)
+                # Used to estimate search costs when the engine does not report its time
+                info.setdefault('time', time.perf_counter() - start)
+            profiling.add('engine nodes', info.get('nodes', 0))
+            return game_id, board, info
+        finally:
+            self.idle.put(engine)
+
+    def _finished(self, future, cacheable):
+        game_id, board, info = future.result()
+        if cacheable:
+            self.cache.put(board, self.key, cacheable, info)
+        return game_id, info
+
+    def analyse(self, positions, limit):
+        """Takes (game_id, board) pairs and yields (game_id, info) as each analysis finishes.
+
+        positions is consumed lazily, keeping a couple of positions queued per engine.
+        """
+        # Only plain depth limits can be answered from the cache (cacheable is the depth)
+        cacheable = self.cache and limit == chess.engine.Limit(depth=limit.depth) and limit.depth
+        pending = set()
+        for game_id, board in positions:
+            info = cacheable and self.cache.get(board, self.key, limit.depth)
+            if cacheable:
+                profiling.add('eval cache hits' if info else 'eval cache misses')
+            if info:
+                yield game_id, info
+                continue
+            pending.add(self.executor.submit(self._analyse, game_id, board.copy(), limit))
+            if len(pending) >= 2 * len(self.engines):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield self._finished(future, cacheable)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield self._finished(future, cacheable)
+
+
+def cp_boundaries(scores):
+    """Centipawn values of the non-mate scores among bucket boundaries such as times.EVALS."""
+    return [score.score() for score in scores if score.score() is not None]
+
+def boundary_distance(score, boundaries):
+    """Centipawns from a PovScore (from white's side) to the nearest boundary, or None for a mate score."""
+    cp = score.white().score()
+    return None if cp is None else min(abs(cp - b) for b in boundaries)
+
+def analyse_within(pool, positions, budget, boundaries, min_depth=8, max_depth=20, step=2, margin=100):
+    """Analyses a batch of (game_id, board) pairs in about budget seconds and returns {game_id: info}.
+
+    Every position is first searched to min_depth, except that those not started by the deadline only get a
+    depth 1 search, so a budget too small for min_depth still returns in about budget seconds. The rest of the
+    budget deepens, step plies at a time, the positions within margin centipawns of a boundary (white's point of
+    view, so boundaries should be symmetric for scores taken from either side), shallowest and then closest
+    first. A round only starts if its estimated time fits in what is left. info['depth'] is the final depth of
+    each position.
+    """
+    deadline = time.perf_counter() + budget
+    boards = dict(positions)
+    results = {}
+    # Seconds per search at each depth, for estimating the next round
+    timings = {}
+
+    def run(game_ids, depth, stop=None):
+        # No search is started after stop (a perf_counter time), though those already running finish
+        queued = ((game_id, boards[game_id]) for game_id in game_ids if stop is None or time.perf_counter() < stop)
+        for game_id, info in pool.analyse(queued, chess.engine.Limit(depth=depth)):
+            # Finished positions (e.g. stalemate) report a lower depth; count them as searched to depth anyway
+            info['depth'] = max(info.get('depth', 0), depth)
+            if 'time' in info:
+                timings.setdefault(info['depth'], []).append(info['time'])
+            if game_id not in results or info['depth'] >= results[game_id]['depth']:
+                results[game_id] = info
+
+    def estimate(depth):
+        known = [d for d in timings if d <= depth]
+        if not known:
+            return 0.0
+        d = max(known)
+        return sum(timings[d]) / len(timings[d]) * BRANCHING ** (depth - d)
+
+    run(boards, min_depth, deadline)
+    run([game_id for game_id in boards if game_id not in results], 1)
+    while True:
+        candidates = []
+        for game_id, info in results.items():
+            distance = boundary_distance(info['score'], boundaries)
+            if info['depth'] < max_depth and distance is not None and distance <= margin:
+                candidates.append((info['depth'], distance, game_id))
+        candidates.sort()
+
+        remaining = deadline - time.perf_counter()
+        rounds, cost = {}, 0.0
+        for depth, distance, game_id in candidates[:2 * len(pool.engines)]:
+            depth = min(max_depth, depth + step)
+            cost += estimate(depth)
+            if cost / len(pool.engines) > remaining:
+                break
+            rounds.setdefault(depth, []).append(game_id)
+        if not rounds:
+            return results
+        for depth, game_ids in sorted(rounds.items()):
+            run(game_ids, depth)
+
+def in_order(results, start=0):
+    """Re-orders (id, value) pairs tagged with consecutive integer ids back into id order."""
+    waiting = {}
+    next_id = start
+    for game_id, value in results:
+        waiting[game_id] = value
+        while next_id in waiting:
+            yield next_id, waiting.pop(next_id)
+            next_id += 1
@@ -0,0 +1,82 @@
+"""
+On-disk cache of engine evaluations, keyed by position and engine settings.
+
+Positions are normalized to EPD (FEN without the move clocks), so transpositions and repeated openings share
+an entry. A cached result is reused for any depth limit up to the depth it was searched to.
+"""
+
+from chess.engine import Cp, Mate, MateGiven, PovScore
+import chess
+import sqlite3
+
+DEFAULT_EVAL_CACHE = '.eval_cache.db'
+DEFAULT_MAX_ENTRIES = 1000000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS evals (
+    position TEXT,
+    engine TEXT,
+    depth INTEGER,
+    score TEXT,
+    used INTEGER,
+    PRIMARY KEY (position, engine)
+);
+CREATE INDEX IF NOT EXISTS evals_used ON evals (used);
+'''
+
+def score_to_str(score):
+    # White's point of view: '+35', '-120', '#+3', '#-0' (white is mated)
+    return str(score.white())
+
+def score_from_str(text, turn):
+    """Rebuilds the score relative to the side to move, as the engine would have reported it."""
+    if text == '#+0':
+        score = MateGiven
+    elif text == '#-0':
+        score = -MateGiven
+    elif text.startswith('#'):
+        score = Mate(int(text[1:]))
+    else:
+        score = Cp(int(text))
+    return PovScore(score if turn == chess.WHITE else -score, turn)
+
+
+class EvalCache:
+    def __init__(self, path=DEFAULT_EVAL_CACHE, max_entries=DEFAULT_MAX_ENTRIES):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        self.max_entries = max_entries
+        self.clock = self.conn.execute('SELECT COALESCE(MAX(used), 0) FROM evals').fetchone()[0]
+
+    def close(self):
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
+
+    def get(self, board, engine, depth):
+        """Returns a cached info dict searched to at least depth, or None."""
+        position = board.epd()
+        row = self.conn.execute('SELECT depth, score FROM evals WHERE position = ? AND engine = ?', (position, engine)).fetchone()
+        if not row or row[0] < depth:
+            return None
+        self.clock += 1
+        self.conn.execute('UPDATE evals SET used = ? WHERE position = ? AND engine = ?', (self.clock, position, engine))
+        return {'score': score_from_str(row[1], board.turn), 'depth': row[0], 'cached': True}
+
+    def put(self, board, engine, depth, info):
+        depth = max(depth, info.get('depth', 0))
+        self.clock += 1
+        self.conn.execute('INSERT INTO evals VALUES (?, ?, ?, ?, ?) ON CONFLICT (position, engine) DO UPDATE '
+                          'SET depth = excluded.depth, score = excluded.score, used = excluded.used WHERE excluded.depth >= evals.depth',
+                          (board.epd(), engine, depth, score_to_str(info['score']), self.clock))
+        if self.clock % 1000 == 0:
+            self.conn.commit()
+            self.evict()
+
+    def evict(self):
+        # Drop the least recently used tenth once over the cap
+        count = self.conn.execute('SELECT COUNT(*) FROM evals').fetchone()[0]
+        if count > self.max_entries:
+            excess = count - self.max_entries + self.max_entries // 10
+            self.conn.execute('DELETE FROM evals WHERE rowid IN (SELECT rowid FROM evals ORDER BY used LIMIT ?)', (excess,))
+            self.conn.commit()
@@ -0,0 +1,53 @@
+"""fakeuci
+
+Minimal UCI engine for benchmarks and offline runs. It returns a made-up but deterministic score for each
+position, after a fixed delay per search depth.
+
+Usage:
+  fakeuci.py [--ms-per-depth=MS]
+  fakeuci.py (-h | --help)
+
+Options:
+  --ms-per-depth=MS  Simulated search time per ply of depth [default: 0.5]
+  -h --help          Show this screen.
+"""
+
+from docopt import docopt
+import sys
+import time
+import zlib
+
+
+def score(position):
+    # Same position command, same score, between -600 and +599 centipawns
+    return zlib.crc32(position.encode()) % 1200 - 600
+
+def main(arguments):
+    ms_per_depth = float(arguments['--ms-per-depth'])
+    position = ''
+    for line in sys.stdin:
+        command = line.split()
+        if not command:
+            continue
+        if command[0] == 'uci':
+            print('id name FakeUCI')
+            print('option name Threads type spin default 1 min 1 max 512')
+            print('option name Hash type spin default 16 min 1 max 33554432')
+            print('uciok')
+        elif command[0] == 'isready':
+            print('readyok')
+        elif command[0] == 'position':
+            position = line.strip()
+        elif command[0] == 'go':
+            depth = int(command[command.index('depth') + 1]) if 'depth' in command else 10
+            time.sleep(depth * ms_per_depth / 1000)
+            print(f'info depth {depth} seldepth {depth} score cp {score(position)} nodes {1000 * depth}')
+            # A null move keeps python-chess from checking legality against the position
+            print('bestmove 0000')
+        elif command[0] == 'quit':
+            break
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    main(arguments)
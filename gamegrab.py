@@ -1,66 +1,296 @@
 """gamegrab
 
 Usage:
-  gamegrab.py [--time-class=TC] [--outfile=OUTFILE] [--color=COLOR] [--since=YYYYMM] [--show-eco-stats] USERNAME
+  gamegrab.py [--time-class=TC] [--outfile=OUTFILE] [--color=COLOR] [--num-games=NUMGAMES] [--since=YYYYMM] [--workers=N] [--cache-dir=DIR] [--stream] [--base-url=URL] [--profile] [--trace=FILE] [--show-eco-stats] [--eco-plies=N] [--line=MOVES] USERNAME
   gamegrab.py (-h | --help)
 
 Options:
   --time-class=TC       Only download games of specified time control.
-  --outfile=OUTFILE     Name of outputfile (defaults to USERNAME.pgn).
+  --outfile=OUTFILE     Name of outputfile (defaults to USERNAME.pgn). Compressed if it ends in .gz or .zst.
   --color=COLOR         Download games of specific color.   
   --num-games=NUMGAMES  Download only this many recent games.
   --since=YYYYMM        Only download games on or after given year and month.
+  --workers=N           Number of monthly archives to download at once (default 8).
+  --cache-dir=DIR       Cache monthly archives in DIR and only re-request months that may have changed.
+  --stream              Parse monthly archives incrementally to keep memory flat on very large months.
+  --base-url=URL        Use another chess.com API host, e.g. a local mockchesscom.py server.
+  --profile             Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE          Also write a Chrome trace event JSON of the run to FILE.
+  --show-eco-stats      Show score and performance by ECO code and by move after downloading.
+  --eco-plies=N         Plies of each game kept in the opening statistics (default 12).
+  --line=MOVES          Break down the games after these moves, e.g. "1.e4 c5 2.Nf3", in the opening statistics.
   -h --help             Show this screen.
 
 Arguments:
   USERNAME      username to download games
 """
 from docopt import docopt
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from archivecache import ArchiveCache
 
+import archivecache
+import codecs
+import datetime
+import itertools
+import openings
+import pgnio
+import profiling
 import requests
 import json
+import os
 import re
+import shutil
+import tempfile
 
 CHESSCOM_HEADERS = { \
     'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36' \
 }
 
+API_URL = 'https://api.chess.com'
+DEFAULT_WORKERS = 8
+CHUNK_SIZE = 1 << 16
+
+
+def make_session(workers=DEFAULT_WORKERS):
+    # One keep-alive connection per worker, shared across all archive requests
+    session = requests.Session()
+    session.headers.update(CHESSCOM_HEADERS)
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+    session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+    return session
+
+def archives_url(user, base_url=API_URL):
+    return f'{base_url}/pub/player/{user}/games/archives'
+
+def game_filter(user, time_class=None, color=None):
+    def wanted(game):
+        return game['rules'] == 'chess' and game['rated'] and (not time_class or game['time_class'] == time_class) and (not color or game[color]['username'].lower()==user.lower())
+    return wanted
+
+def select_archives(urls, since=None):
+    """Monthly archive urls newest-first, dropping months before since (YYYYMM)."""
+    archives = []
+    for url in urls[::-1]:
+        if since:
+            url_year, url_month = map(int, url.split('/')[-2:])
+            if url_year < int(since[:4]) or (url_year == int(since[:4]) and url_month < int(since[4:6])):
+                continue
+        archives.append(url)
+    return archives
+
+def fetch_json(session, url, cache=None):
+    profiling.log(f'Downloading {url}...')
+    if cache:
+        body = cache.get(session, url)
+    else:
+        with profiling.stage('download', url=url):
+            response = session.get(url)
+            response.raise_for_status()
+            body = response.content
+        profiling.add('bytes fetched', len(body))
+    with profiling.stage('json decode'):
+        return json.loads(body)
+
+def fetch_games(session, url, cache=None):
+    return fetch_json(session, url, cache)['games']
+
+def fetch_body(session, url, cache=None):
+    """Downloads an archive to disk without decoding it and returns it as an open binary file."""
+    profiling.log(f'Downloading {url}...')
+    if cache:
+        return open(cache.fetch(session, url), 'rb')
+    body = tempfile.TemporaryFile()
+    with profiling.stage('download', url=url), session.get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_SIZE):
+            body.write(chunk)
+            profiling.add('bytes fetched', len(chunk))
+    body.seek(0)
+    return body
+
+def read_chunks(f, size=CHUNK_SIZE):
+    while chunk := f.read(size):
+        yield chunk
+
+def iter_games(chunks):
+    """Yields the objects of an archive's 'games' array one at a time from an iterable of byte chunks."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, in_array = '', False
+    for chunk in chunks:
+        buf += utf8.decode(chunk)
+        pos = 0
+        if not in_array:
+            key = buf.find('"games"')
+            start = buf.find('[', key) if key >= 0 else -1
+            if start < 0:
+                continue
+            pos, in_array = start + 1, True
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if buf.startswith(']', pos):
+                return
+            try:
+                game, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Game continues in the next chunk
+                break
+            yield game
+        buf = buf[pos:]
+    raise ValueError('Archive ended before its games array was closed.')
+
+def iter_matches_reversed(body, wanted):
+    """Streams an archive body and yields the pgn of wanted games newest-first, spooling matches to disk."""
+    offsets = [0]
+    with body, tempfile.TemporaryFile() as spool:
+        for game in profiling.timed(iter_games(read_chunks(body)), 'json decode'):
+            if wanted(game):
+                spool.write(game['pgn'].encode())
+                offsets.append(spool.tell())
+        for start, end in reversed(list(zip(offsets, offsets[1:]))):
+            spool.seek(start)
+            yield spool.read(end - start).decode()
+
+def close_result(future):
+    """Closes what a finished prefetch that will not be read returned, if it is a file (see fetch_body)."""
+    if not future.cancelled() and future.exception() is None and hasattr(future.result(), 'close'):
+        future.result().close()
+
+def iter_archives(session, urls, workers=DEFAULT_WORKERS, cache=None, fetch=fetch_games):
+    """Yields fetch(url) for each archive url in order, keeping at most `workers` downloads in flight."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        urls = iter(urls)
+        try:
+            for url in urls:
+                pending.append(executor.submit(fetch, session, url, cache))
+                if len(pending) >= workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Stopping early (e.g. --num-games reached) drops the prefetched months, closing those already fetched
+            for future in pending:
+                if not future.cancel():
+                    future.add_done_callback(close_result)
+
+def write_games(f, months, num_games=None):
+    game_ctr = 0
+    for pgns in months:
+        for pgn in pgns:
+            try:
+                f.write(pgn)
+                f.write('\n')
+                game_ctr += 1
+                profiling.progress('games')
+                if num_games and game_ctr >= num_games:
+                    return game_ctr
+            except UnicodeEncodeError: # hack
+                print('UnicodeEncodeError, skipping game.')
+                continue
+    return game_ctr
+
+class Checkpoint:
+    """Months written so far by a download into OUTFILE.parts/, one PGN per month.
+
+    Months that can no longer change are recorded in manifest.json as soon as their part is complete, so a run that
+    fails partway resumes after them. The manifest is keyed by the download's filters and dropped if they change.
+    """
+    def __init__(self, outfile, key):
+        self.dir = f'{outfile}.parts'
+        self.manifest_path = os.path.join(self.dir, 'manifest.json')
+        self.key = key
+        # Games in each month's part: final months from the manifest, plus every month written in this run
+        self.games, self.final = {}, {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['key'] == key:
+                self.final = manifest['months']
+                self.games.update(self.final)
+        os.makedirs(self.dir, exist_ok=True)
+
+    def part_path(self, url):
+        year, month = archivecache.month_of(url)
+        return os.path.join(self.dir, f'{year:04}-{month:02}.pgn')
+
+    def done(self, url):
+        return url in self.final and os.path.exists(self.part_path(url))
+
+    def write(self, url, pgns, final):
+        tmp = f'{self.part_path(url)}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            self.games[url] = write_games(f, [pgns])
+        os.replace(tmp, self.part_path(url))
+        if final:
+            self.final[url] = self.games[url]
+            archivecache.write_atomic(self.manifest_path, json.dumps({'key': self.key, 'months': self.final}).encode())
+
+    def assemble(self, outfile, urls, num_games=None):
+        """Writes the parts of urls in order into outfile, replacing it in one step, and removes the checkpoint."""
+        tmp = f'{outfile}.tmp'
+        remaining = num_games
+        with pgnio.open_pgn(tmp, 'wb', pgnio.compression_of(outfile)) as out:
+            for url in urls:
+                with open(self.part_path(url), 'rb') as part:
+                    if remaining is not None and self.games[url] > remaining:
+                        # Only the first games of the last month are wanted
+                        games = list(itertools.islice(pgnio.scan_pgn(self.part_path(url)), remaining + 1))
+                        out.write(part.read(games[remaining].offset))
+                        break
+                    shutil.copyfileobj(part, out)
+                if remaining is not None:
+                    remaining -= self.games[url]
+        os.replace(tmp, outfile)
+        shutil.rmtree(self.dir)
 
 def main(arguments):
     user = arguments['USERNAME']
-    outfile = arguments['--outfile'] if '--outfile' in arguments else f'{user}.pgn'
-    time_class = arguments['--time-class'] if '--time-class' in arguments else None
+    outfile = arguments.get('--outfile') or f'{user}.pgn'
+    time_class = arguments.get('--time-class')
     color = arguments['--color'].lower() if arguments.get('--color') else None
-    since = arguments['--since'] if '--since' in arguments else None
-    num_games = int(arguments['--num-games']) if '--num-games' in arguments else None
-
-    if since:
-        from_year = int(since[:4])
-        from_month = int(since[4:6])
-
-    with open(outfile, 'w') as f:
-        urls = requests.get('https://api.chess.com/pub/player/{0}/games/archives'.format(user), headers=CHESSCOM_HEADERS)
-        game_ctr = 0
-        for url in urls.json()['archives'][::-1]:
-            if since:
-                url_year, url_month = map(int, url.split('/')[-2:])
-                if url_year < from_year or (url_year == from_year and url_month < from_month):
-                    continue
-            #print('Downloading {url}...'.format(url=url), flush=True)
-            games = requests.get(url, headers=CHESSCOM_HEADERS)
-            for game in games.json()['games'][::-1]:
-                if game['rules'] == 'chess' and game['rated'] and (not time_class or game['time_class'] == time_class) and (not color or game[color]['username'].lower()==user.lower()):
-                    pgn = game['pgn'].replace('\\n', '\n')
-                    try:
-                        f.write(game['pgn'])
-                        f.write('\n')
-                        game_ctr += 1
-                        if num_games and game_ctr >= num_games:
-                            return 
-                    except UnicodeEncodeError: # hack
-                        print('UnicodeEncodeError, skipping month.')
-                        continue
+    since = arguments.get('--since')
+    num_games = int(arguments['--num-games']) if arguments.get('--num-games') else None
+    workers = int(arguments.get('--workers') or DEFAULT_WORKERS)
+    cache = ArchiveCache(arguments['--cache-dir']) if arguments.get('--cache-dir') else None
+    stream = arguments.get('--stream')
+
+    base_url = arguments.get('--base-url') or API_URL
+    wanted = game_filter(user, time_class, color)
+    checkpoint = Checkpoint(outfile, {'user': user.lower(), 'time_class': time_class, 'color': color, 'base_url': base_url})
+
+    session = make_session(workers)
+    urls = fetch_json(session, archives_url(user, base_url), cache)
+    archives = select_archives(urls['archives'], since)
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    # Months finished by an interrupted run are not downloaded again
+    months = iter_archives(session, [url for url in archives if not checkpoint.done(url)], workers, cache, fetch_body if stream else fetch_games)
+    written, game_ctr = [], 0
+    try:
+        for url in archives:
+            if not checkpoint.done(url):
+                month = next(months)
+                pgns = iter_matches_reversed(month, wanted) if stream else (game['pgn'] for game in month[::-1] if wanted(game))
+                checkpoint.write(url, pgns, archivecache.month_is_final(url, now))
+            written.append(url)
+            game_ctr += checkpoint.games[url]
+            if num_games and game_ctr >= num_games:
+                break
+    finally:
+        months.close()
+    checkpoint.assemble(outfile, written, num_games)
+
+    if arguments.get('--show-eco-stats'):
+        plies = int(arguments.get('--eco-plies') or openings.DEFAULT_PLIES)
+        with profiling.stage('analysis'):
+            trie = openings.build(profiling.timed(pgnio.scan_pgn(outfile), 'pgn parse'), user, plies)
+        openings.print_stats(trie, arguments.get('--line') or '')
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
-    main(arguments)
+    with profiling.session(arguments):
+        main(arguments)
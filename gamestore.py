@@ -0,0 +1,158 @@
+"""gamestore
+Ingests a PGN archive into a SQLite table with one row per game, so analyses can query headers and clocks
+instead of re-parsing the PGN.
+
+Usage:
+  gamestore.py [--db=DB] [--profile] [--trace=FILE] PGNFILE
+  gamestore.py (-h | --help)
+
+Options:
+  --db=DB       Store to write (defaults to PGNFILE.db).
+  --profile     Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE  Also write a Chrome trace event JSON of the run to FILE.
+  -h --help     Show this screen.
+
+Arguments:
+  PGNFILE       PGN archive to ingest
+"""
+
+from array import array
+from docopt import docopt
+import chess.pgn
+import os
+import pgnio
+import profiling
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    offset INTEGER,
+    link TEXT,
+    white TEXT,
+    black TEXT,
+    white_elo INTEGER,
+    black_elo INTEGER,
+    result TEXT,
+    time_control TEXT,
+    time_class TEXT,
+    utc_date TEXT,
+    utc_time TEXT,
+    eco TEXT,
+    fen TEXT,
+    plies INTEGER,
+    clocks BLOB
+);
+CREATE INDEX IF NOT EXISTS games_time_control ON games (time_control, utc_date);
+CREATE INDEX IF NOT EXISTS games_time_class ON games (time_class, utc_date);
+'''
+
+# Maps store columns back to the PGN header names the analysis scripts use
+HEADER_COLUMNS = {
+    'Link': 'link', 'White': 'white', 'Black': 'black', 'WhiteElo': 'white_elo', 'BlackElo': 'black_elo',
+    'Result': 'result', 'TimeControl': 'time_control', 'UTCDate': 'utc_date', 'UTCTime': 'utc_time',
+    'ECO': 'eco', 'FEN': 'fen',
+}
+
+def default_db(pgnfile):
+    return f'{pgnfile}.db'
+
+def get_time_class(time_control):
+    # chess.com classifies by estimated duration of a 40 move game
+    if '/' in time_control:
+        return 'daily'
+    base, _, inc = time_control.partition('+')
+    duration = int(base) + 40 * int(inc or 0)
+    if duration < 180:
+        return 'bullet'
+    elif duration < 600:
+        return 'blitz'
+    return 'rapid'
+
+class StoredGame:
+    """A stored row that looks enough like a chess.pgn.Game for header-based helpers like get_user_perf."""
+    __slots__ = ('offset', 'plies', 'clocks', 'headers')
+
+    def __init__(self, row):
+        self.offset = row['offset']
+        self.plies = row['plies']
+        self.clocks = array('i', row['clocks'])
+        self.headers = {name: str(row[column]) for name, column in HEADER_COLUMNS.items() if row[column] is not None}
+
+def connect(db):
+    conn = sqlite3.connect(db)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+def ingest(pgnfile, db=None):
+    conn = connect(db or default_db(pgnfile))
+    with conn:
+        conn.execute('DELETE FROM games')
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('pgnfile', os.path.abspath(pgnfile)))
+        rows = []
+        for game in profiling.timed(pgnio.scan_pgn(pgnfile), 'pgn parse'):
+            h = game.headers
+            rows.append((game.offset, h.get('Link'), h.get('White'), h.get('Black'), int(h.get('WhiteElo', 0)), int(h.get('BlackElo', 0)),
+                         h.get('Result'), h.get('TimeControl'), get_time_class(h.get('TimeControl', '0')), h.get('UTCDate'), h.get('UTCTime'),
+                         h.get('ECO'), h.get('FEN'), game.plies, game.clocks.tobytes()))
+        conn.executemany('INSERT INTO games (offset, link, white, black, white_elo, black_elo, result, time_control, time_class, '
+                         'utc_date, utc_time, eco, fen, plies, clocks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+def query(db, time_controls=None, time_class=None, since=None, until=None, min_plies=None, limit=None):
+    """Yields StoredGames in archive order. since/until are inclusive YYYYMM or YYYY.MM.DD bounds on UTCDate."""
+    clauses, params = [], []
+    if time_controls:
+        clauses.append(f'time_control IN ({", ".join("?" * len(time_controls))})')
+        params.extend(time_controls)
+    if time_class:
+        clauses.append('time_class = ?')
+        params.append(time_class)
+    if since:
+        clauses.append('utc_date >= ?')
+        params.append(to_pgn_date(since))
+    if until:
+        clauses.append('utc_date <= ?')
+        params.append(to_pgn_date(until, end=True))
+    if min_plies:
+        clauses.append('plies >= ?')
+        params.append(min_plies)
+
+    sql = 'SELECT * FROM games'
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY offset'
+    if limit:
+        sql += f' LIMIT {int(limit)}'
+
+    conn = connect(db)
+    for row in conn.execute(sql, params):
+        yield StoredGame(row)
+    conn.close()
+
+def to_pgn_date(date, end=False):
+    if '.' in date:
+        return date
+    return f'{date[:4]}.{date[4:6]}.{"99" if end else "00"}'
+
+def get_pgnfile(db):
+    with connect(db) as conn:
+        return conn.execute("SELECT value FROM meta WHERE key = 'pgnfile'").fetchone()[0]
+
+def read_full_game(pgn, game):
+    """Parses the full python-chess game behind a StoredGame or clocks.ScannedGame from the open source PGN."""
+    pgn.seek(game.offset)
+    return chess.pgn.read_game(pgn)
+
+def main(arguments):
+    pgnfile = arguments['PGNFILE']
+    db = arguments.get('--db') or default_db(pgnfile)
+    n = ingest(pgnfile, db)
+    print(f'Stored {n} games in {db}')
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    with profiling.session(arguments):
+        main(arguments)
@@ -2,15 +2,18 @@
 Plots user's n-game moving rating average over time on chess.com.
 
 Usage:
-  graph.py [--time-class=TC] [--since=YYYYMM] [--moving-avg=N] [--download] [--every-game] USERNAME
+  graph.py [--time-class=TC] [--since=YYYYMM] [--moving-avg=N] [--download] [--every-game] [--store=DB] [--profile] [--trace=FILE] USERNAME
   graph.py (-h | --help)
 
 Options:
   --time-class=TC       Time class to consider (default blitz).
   --moving-avg=N        Show n-game moving rating average (default 500).
   --since=YYYYMM        Only download games on or after given year and month.
-  --download            Re-download games history.
+  --download            Refresh games history (finished months come from the local archive cache).
   --every-game          Show one point on the graph for every game
+  --store=DB            Read games from a gamestore database instead of the PGN.
+  --profile             Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE          Also write a Chrome trace event JSON of the run to FILE.
   -h --help             Show this screen.
 
 Arguments:
@@ -18,57 +21,69 @@ Arguments:
 """
 
 from docopt import docopt
-import chess.pgn
+import archivecache
 import gamegrab
+import gamestore
 import os
+import numpy as np
 import pandas as pd
+import pgnio
+import profiling
+import records
 import plotly.express as px
 
+def rating_history(games, moving_avg):
+    """The user's rating in every game of a records.GameRecords, sorted by time, with the moving_avg-game average in 'avg'."""
+    # Games may not be ordered correctly
+    order = np.argsort(games.games['timestamp'], kind='stable')
+    timestamps = games.games['timestamp'][order].astype('datetime64[s]')
+    history = pd.DataFrame({'date': timestamps.astype('datetime64[D]'), 'time': timestamps, 'rating': games.user_ratings()[order]})
+
+    # avg[i] is the mean of the moving_avg ratings ending at game i, from a running sum in O(n)
+    ratings = history['rating'].to_numpy()
+    cumulative = np.concatenate(([0], np.cumsum(ratings)))
+    history['avg'] = 0
+    history.loc[moving_avg - 1:, 'avg'] = (cumulative[moving_avg:] - cumulative[:-moving_avg]) // moving_avg
+
+    return history
+
 def main(arguments):
     username = arguments['USERNAME']
     time_class = arguments.get('--time-class') or 'blitz'
     moving_avg = int(arguments.get('--moving-avg') or 500)
     since = arguments['--since'] if '--since' in arguments else None
     every_game = arguments.get('--every-game')
+    store = arguments.get('--store')
 
-    pgnfile = f'{time_class}_{username}.pgn'
-    if not os.path.exists(pgnfile) or arguments.get('--download'):
-        gamegrab.main({'USERNAME': username, '--time-class': time_class,  '--outfile': pgnfile, '--color': None, '--since': None})
-
-    history = []
-    with open(pgnfile) as f:
-        while headers := chess.pgn.read_headers(f):
-            rating = int(headers['WhiteElo']) if headers['White'].lower() == username.lower() else int(headers['BlackElo'])
-            date = headers['UTCDate']
-            time = headers['UTCTime']
+    if store:
+        games = records.GameRecords.from_games(gamestore.query(store, time_class=time_class, since=since), username)
+    else:
+        pgnfile = pgnio.find_pgn(f'{time_class}_{username}.pgn')
+        if not os.path.exists(pgnfile) or arguments.get('--download'):
+            gamegrab.main({'USERNAME': username, '--time-class': time_class,  '--outfile': pgnfile, '--color': None, '--since': None, '--cache-dir': archivecache.DEFAULT_CACHE_DIR})
+        # Key headers come from the index, so the PGN itself is only scanned for newly added games
+        since_date = gamestore.to_pgn_date(since) if since else ''
+        # Index entries are streamed into the compact records, so their header dicts never pile up
+        with profiling.stage('pgn index'):
+            games = records.GameRecords.from_games(
+                (entry for entry in pgnio.index_games(pgnfile) if entry.headers['UTCDate'] >= since_date), username)
 
-            history.append((f'{date} {time}', rating))
+    with profiling.stage('analysis'):
+        history = rating_history(games, moving_avg)
+    profiling.add('games', len(history))
 
-    # Games may not ordered correctly
-    history = sorted(history, key=lambda x:x[0])
-    
-    dates_to_n = {}
-    dates, ratings = [], []
-    for i, (time, rating) in enumerate(history[moving_avg:], start=moving_avg):
-        date = time.split(' ')[0]
-        avg = int(sum(x[1] for x in history[i-moving_avg+1:i+1]) / moving_avg) 
-        if every_game:
-            dates.append(dates[-1] + 1 if len(dates) else 1)
-            ratings.append(rating)
-        elif len(dates) == 0 or dates[-1] != date:
-           dates.append(date)
-           ratings.append(avg)
-        else:
-            ratings[-1] = avg
-        if date not in dates_to_n:
-            dates_to_n[date] = 0
-        dates_to_n[date] += 1
-    
-    df = pd.DataFrame({'date': dates, 'rating': ratings})
+    plotted = history.iloc[moving_avg:]
+    if every_game:
+        df = pd.DataFrame({'date': np.arange(1, len(plotted) + 1), 'rating': plotted['rating'].to_numpy()})
+    else:
+        # One point per day, showing the average as of that day's last game
+        daily = plotted.groupby('date', sort=True)['avg'].last()
+        df = pd.DataFrame({'date': daily.index, 'rating': daily.to_numpy()})
     fig = px.line(df, x="date", y="rating", title=f"{moving_avg}-game {time_class} rating average for {username}")
 
-    for x in sorted(dates_to_n.keys()):
-        print(x, dates_to_n[x])
+    dates_to_n = plotted.groupby('date', sort=True).size()
+    for x, n in dates_to_n.items():
+        print(x.strftime('%Y.%m.%d'), n)
 
     fig.show()
 
@@ -76,4 +91,5 @@ def main(arguments):
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
-    main(arguments)
+    with profiling.session(arguments):
+        main(arguments)
@@ -0,0 +1,180 @@
+"""mockchesscom
+
+Local stand-in for the chess.com published-data API, serving synthetic games so downloads can be tested offline.
+
+Usage:
+  mockchesscom.py [--port=PORT] [--months=N] [--games=N] [--max-rps=R] [--retry-after=SEC] [--seed=SEED]
+  mockchesscom.py (-h | --help)
+
+Options:
+  --port=PORT        Port to listen on [default: 8765]
+  --months=N         Months of archives per user, ending with the current month [default: 12]
+  --games=N          Games per user per month [default: 20]
+  --max-rps=R        Answer 429 Too Many Requests above R requests per second, 0 for no limit [default: 0]
+  --retry-after=SEC  Retry-After sent with a 429 [default: 1]
+  --seed=SEED        Seed for the synthetic games [default: 0]
+  -h --help          Show this screen.
+
+Any username is accepted. Point gamegrab.py or batchgrab.py at it with --base-url=http://127.0.0.1:PORT.
+"""
+
+from collections import deque
+from docopt import docopt
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import archivecache
+import chess
+import chess.pgn
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+
+ROUTE_REGEX = re.compile(r'/pub/player/([^/]+)/games/(?:archives|(\d{4})/(\d{2}))/?')
+TIME_CONTROLS = {'60': 'bullet', '180': 'blitz', '180+2': 'blitz', '300': 'blitz', '600': 'rapid'}
+RESULTS = {'1-0': ('win', 'resigned'), '0-1': ('resigned', 'win'), '1/2-1/2': ('agreed', 'agreed')}
+
+
+def clock_str(tenths):
+    return f'{tenths // 36000}:{tenths // 600 % 60:02d}:{tenths % 600 // 10:02d}.{tenths % 10}'
+
+def make_game(rng, user, opponent, year, month, index):
+    """One chess.com archive entry with a random legal game and %clk comments."""
+    time_control = rng.choice(list(TIME_CONTROLS))
+    base, _, inc = time_control.partition('+')
+    clocks = [int(base) * 10] * 2
+    user_is_white = rng.random() < 0.5
+    white, black = (user, opponent) if user_is_white else (opponent, user)
+    white_elo, black_elo = rng.randint(1000, 2400), rng.randint(1000, 2400)
+    result = rng.choice(list(RESULTS))
+    end = datetime.datetime(year, month, rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59))
+    link = f'https://www.chess.com/game/live/{year}{month:02d}{index:05d}'
+
+    game = chess.pgn.Game()
+    game.headers.update({'Event': 'Live Chess', 'Site': 'Chess.com', 'Date': end.strftime('%Y.%m.%d'), 'Round': '-',
+                         'White': white, 'Black': black, 'Result': result, 'ECO': rng.choice(('A00', 'B20', 'C50', 'D02')),
+                         'UTCDate': end.strftime('%Y.%m.%d'), 'UTCTime': end.strftime('%H:%M:%S'),
+                         'WhiteElo': str(white_elo), 'BlackElo': str(black_elo), 'TimeControl': time_control, 'Link': link})
+    node, board = game, chess.Board()
+    for ply in range(rng.randint(10, 120)):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        move = rng.choice(moves)
+        side = ply % 2
+        clocks[side] = max(0, clocks[side] - rng.choice((1, 1, 2, 5, 10, 30, 200))) + int(inc or 0) * 10
+        node = node.add_variation(move, comment=f'[%clk {clock_str(clocks[side])}]')
+        board.push(move)
+
+    return {
+        'url': link, 'pgn': str(game), 'time_control': time_control, 'end_time': int(end.replace(tzinfo=datetime.timezone.utc).timestamp()),
+        'rated': rng.random() < 0.9, 'time_class': TIME_CONTROLS[time_control], 'rules': 'chess',
+        'white': {'rating': white_elo, 'result': RESULTS[result][0], 'username': white},
+        'black': {'rating': black_elo, 'result': RESULTS[result][1], 'username': black},
+    }
+
+@lru_cache(maxsize=256)
+def month_archive(user, year, month, games, seed):
+    rng = random.Random(f'{seed}/{user.lower()}/{year}/{month}')
+    return json.dumps({'games': [make_game(rng, user, f'opponent{rng.randint(1, 500)}', year, month, i) for i in range(games)]}).encode()
+
+def recent_months(n):
+    year, month = archivecache.current_month()
+    months = []
+    for _ in range(n):
+        months.append((year, month))
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+    return months[::-1]
+
+
+class MockChessCom(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, months=12, games=20, max_rps=0, retry_after=1, seed=0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.months, self.games, self.seed = months, games, seed
+        self.max_rps, self.retry_after = max_rps, retry_after
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.requests, self.throttled = 0, 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def throttle(self):
+        """Counts a request and returns True if it is over the per-second limit."""
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            while self.recent and self.recent[0] < now - 1:
+                self.recent.popleft()
+            if self.max_rps and len(self.recent) >= self.max_rps:
+                self.throttled += 1
+                return True
+            self.recent.append(now)
+            return False
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body):
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if server.throttle():
+            self.send_response(429)
+            self.send_header('Retry-After', str(server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        match = ROUTE_REGEX.fullmatch(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        user, year, month = match.groups()
+        if year is None:
+            urls = [f'{server.url}/pub/player/{user}/games/{y}/{m:02d}' for y, m in recent_months(server.months)]
+            self.send_body(json.dumps({'archives': urls}).encode())
+        elif (int(year), int(month)) in recent_months(server.months):
+            self.send_body(month_archive(user, int(year), int(month), server.games, server.seed))
+        else:
+            self.send_error(404)
+
+
+def serve(**options):
+    """Starts a MockChessCom on a background thread (on a free port unless port is given) and returns it."""
+    server = MockChessCom(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(arguments):
+    server = MockChessCom(int(arguments['--port']), int(arguments['--months']), int(arguments['--games']),
+                          float(arguments['--max-rps']), int(arguments['--retry-after']), int(arguments['--seed']))
+    print(f'Serving mock chess.com API on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    main(arguments)
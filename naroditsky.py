@@ -1,25 +1,33 @@
 """naroditsky
 
 Usage:
-  naroditsky.py [--num_games=NUMGAMES] [--threshold=THRESHOLD] USERNAME
+  naroditsky.py [--num_games=NUMGAMES] [--threshold=THRESHOLD] [--store=DB] [--jobs=N] [--profile] [--trace=FILE] USERNAME
   naroditsky.py (-h | --help)
 
 Options:
   --num_games=NUMGAMES    Only download last n games [default: 25]
   --threshold=THRESHOLD   Point out moves where more than THRESHOLD sec spent [default: 15]
+  --store=DB              Analyze games from a gamestore database instead of downloading.
+  --jobs=N                Analyze the PGN in N processes [default: 1]
+  --profile               Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE            Also write a Chrome trace event JSON of the run to FILE.
   -h --help               Show this screen.
 
 Arguments:
   USERNAME      username to download games
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from docopt import docopt
 
 
-import chess
-import chess.pgn
+import clocks
 import gamegrab
-import re
+import gamestore
+import itertools
+import pgnio
+import profiling
+import stats
 
 def tenths_sec_to_str(time_tenths):
    min = time_tenths // 600
@@ -49,90 +57,121 @@ def get_user_perf(game, username):
 
     return perf
 
-def find_long_thinks(game, username, threshold):
-    clock_regex = re.compile(r'.*%clk 0:([0-9]*):([0-9\\.]*)')
-
-    node = game.root()
-    node.comment = f'{game.headers["Link"]}'
-    comments = False
-    
-    prev_time_tenths_sec = int(game.headers['TimeControl'].split('+')[0]) * 10
-    while node.next():
-        prev_node = node
-        node = node.next()
-
-        if is_user_to_move(game, node, username):
-            min, sec = map(float, clock_regex.match(node.comment).groups())
-            time_tenths_sec = min * 600 + sec * 10
-
-            delta = prev_time_tenths_sec - time_tenths_sec
-            if delta >= threshold:
-                comments = True
-                node.comment += tenths_sec_to_str(delta)
-
-            prev_time_tenths_sec = time_tenths_sec
-
-    return str(game) if comments else ''
-
-def was_time_scramble(game):
-    scramble_regex = r'%clk 0:00:[0-1][0-9](?:\.[0-9])?[^%]*%clk 0:00:[0-1][0-9](?:\.[0-9])?'
-    return len(re.findall(scramble_regex, str(game))) >= 5
+def find_long_thinks(game, username, threshold, timeline=None):
+    if timeline is None:
+        timeline = clocks.ClockTimeline.from_game(game)
+    long_thinks = timeline.long_thinks(is_user_white(game, username), threshold)
+    if not long_thinks:
+        return ''
+
+    game.comment = f'{game.headers["Link"]}'
+    nodes = list(game.mainline())
+    for ply, delta in long_thinks:
+        nodes[ply].comment += tenths_sec_to_str(delta)
+    return str(game)
+
+def was_time_scramble(game, timeline=None):
+    # Five pairs of consecutive clocks under 20 sec
+    if timeline is None:
+        timeline = clocks.ClockTimeline.from_game(game)
+    return timeline.was_scramble(200)
+
+def analyze_game(game, source, username, threshold):
+    """Returns (perf, annotated pgn or '', plies, reached time scramble) for one scanned or stored game."""
+    with profiling.stage('analysis'):
+        timeline = clocks.ClockTimeline.from_game(game)
+        long_think = timeline.long_thinks(is_user_white(game, username), threshold*10)
+    if long_think:
+        # Only games that need annotating are parsed from the PGN, reusing the clocks already read
+        with profiling.stage('pgn parse'):
+            full_game = gamestore.read_full_game(source, game)
+        with profiling.stage('analysis'):
+            result = find_long_thinks(full_game, username, threshold*10, timeline)
+    else:
+        result = ''
+    return get_user_perf(game, username), result, game.plies, was_time_scramble(game, timeline)
+
+def analyze_chunk(args):
+    pgnfile, entries, username, threshold = args
+    with pgnio.open_pgn(pgnfile) as source:
+        return [analyze_game(game, source, username, threshold) for game in pgnio.iter_indexed(pgnfile, entries)]
 
 def main(arguments):
     username = arguments['USERNAME']
     num_games = int(arguments['--num_games'])
     threshold = int(arguments['--threshold'])
-
-    pgnfile = f'{username}.pgn'
-    gamegrab.main({'USERNAME': username, '--blitz-only': True, '--num-games': num_games, '--outfile': pgnfile, '--color': None, '--since': None})
+    store = arguments.get('--store')
+    jobs = int(arguments.get('--jobs') or 1)
+
+    if store:
+        games = gamestore.query(store, limit=num_games + 1)
+        source = pgnio.open_pgn(gamestore.get_pgnfile(store))
+    else:
+        pgnfile = pgnio.find_pgn(f'{username}.pgn')
+        gamegrab.main({'USERNAME': username, '--blitz-only': True, '--num-games': num_games, '--outfile': pgnfile, '--color': None, '--since': None})
+        # Only the games we will look at are read, straight from their indexed offsets
+        entries = pgnio.update_index(pgnfile)[:num_games + 1]
+        games = pgnio.iter_indexed(pgnfile, entries)
+        source = pgnio.open_pgn(pgnfile)
 
     print('Analyzing games...', flush=True)
 
-    no_long_think_perfs = []
-    long_think_perfs = []
+    no_long_think_perfs = stats.Moments()
+    long_think_perfs = stats.Moments()
 
-    scramble_perfs = []
-    total_perfs = []
+    scramble_perfs = stats.Moments()
+    total_perfs = stats.Moments()
 
     think_moves, total_moves = 0, 0
 
-    pgn = open(pgnfile)
+    executor = None
+    if jobs > 1 and not store and entries:
+        # Chunks come back in file order, so the loop below sees games exactly as in a serial run
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        size = -(-len(entries) // (jobs * 4))
+        chunks = [(pgnfile, entries[i:i + size], username, threshold) for i in range(0, len(entries), size)]
+        results = itertools.chain.from_iterable(executor.map(analyze_chunk, chunks))
+    else:
+        results = (analyze_game(game, source, username, threshold) for game in profiling.timed(games, 'pgn parse'))
+
     with open(f'annotated_{username}.pgn', 'w') as outfile:
         ctr = 0
-        while game := chess.pgn.read_game(pgn):
-            result = find_long_thinks(game, username, threshold*10)
-            perf = get_user_perf(game, username)
-
+        for perf, result, plies, scramble in results:
+            profiling.progress('games')
             if result:
                 outfile.write(result)
                 outfile.write('\n\n')
 
-                long_think_perfs.append(perf)
+                long_think_perfs.add(perf)
 
                 think_moves += str(result).count('sec')
             else:
-                no_long_think_perfs.append(perf)
+                no_long_think_perfs.add(perf)
 
-            total_moves += sum(1 for m in game.mainline_moves()) // 2
+            total_moves += plies // 2
             
-            if was_time_scramble(game):
-                scramble_perfs.append(perf)
-            total_perfs.append(perf)
+            if scramble:
+                scramble_perfs.add(perf)
+            total_perfs.add(perf)
                 
             if ctr == num_games:
                 break
             ctr += 1
 
+    if executor:
+        executor.shutdown(cancel_futures=True)
+
     slow_rate = think_moves / ctr 
     print(f'{threshold} sec think rate: {slow_rate:.3f}/game')
-    print(f'Games with no {threshold} sec thinks: {len(no_long_think_perfs)}. Avg perf: {int(sum(no_long_think_perfs) / len(no_long_think_perfs))}')
-    print(f'Games with {threshold} sec thinks: {len(long_think_perfs)}. Avg perf: {int(sum(long_think_perfs) / len(long_think_perfs))}')
+    print(f'Games with no {threshold} sec thinks: {no_long_think_perfs.count}. Avg perf: {int(no_long_think_perfs.mean)}')
+    print(f'Games with {threshold} sec thinks: {long_think_perfs.count}. Avg perf: {int(long_think_perfs.mean)}')
 
     print()
-    print(f'Games reaching time scrambles: {len(scramble_perfs)}')
-    scramble_perf = int(sum(scramble_perfs) / len(scramble_perfs)) if len(scramble_perfs) > 0 else 'N/A'
-    print(f'Perf in time scrambles: {scramble_perf} (compared to {int(sum(total_perfs) / len(total_perfs))} overall)')
+    print(f'Games reaching time scrambles: {scramble_perfs.count}')
+    scramble_perf = int(scramble_perfs.mean) if scramble_perfs.count > 0 else 'N/A'
+    print(f'Perf in time scrambles: {scramble_perf} (compared to {int(total_perfs.mean)} overall)')
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
-    main(arguments)
+    with profiling.session(arguments):
+        main(arguments)
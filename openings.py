@@ -0,0 +1,107 @@
+"""
+Opening statistics: a trie of the user's games keyed by their first moves, with ECO code rollups.
+
+Every node holds the games, score and performance rating of the games that started with its move sequence, for
+the user as white or as black. It is built in one pass over a scanned PGN, and each node is also kept in a dict
+keyed by its moves, so the stats after a given line are a single lookup.
+"""
+
+import clocks
+import stats
+import timestats
+
+DEFAULT_PLIES = 12
+POINTS = {'1-0': (1.0, 0.0), '0-1': (0.0, 1.0), '1/2-1/2': (0.5, 0.5)}
+
+
+class OpeningNode:
+    """Games reaching one move sequence: perf is the user's performance rating, score their points per game."""
+    __slots__ = ('moves', 'children', 'perf', 'score')
+
+    def __init__(self, moves=()):
+        self.moves = moves
+        self.children = {}
+        self.perf = stats.Moments()
+        self.score = stats.Moments()
+
+    @property
+    def games(self):
+        return self.perf.count
+
+    def add(self, perf, points):
+        self.perf.add(perf)
+        self.score.add(points)
+
+
+class OpeningTrie:
+    __slots__ = ('plies', 'roots', 'nodes', 'ecos')
+
+    def __init__(self, plies=DEFAULT_PLIES):
+        self.plies = plies
+        # One tree per user color, keyed by True for white
+        self.roots = {True: OpeningNode(), False: OpeningNode()}
+        self.nodes = {(True, ()): self.roots[True], (False, ()): self.roots[False]}
+        self.ecos = {}
+
+    def add_game(self, game, username):
+        """Adds a game with headers and a moves() method, e.g. a clocks.ScannedGame."""
+        result = game.headers.get('Result')
+        if result not in POINTS:
+            return
+        white = timestats.is_user_white(game, username)
+        perf = timestats.get_user_perf(game, username)
+        points = POINTS[result][0 if white else 1]
+
+        node = self.roots[white]
+        node.add(perf, points)
+        for san in game.moves()[:self.plies]:
+            child = node.children.get(san)
+            if child is None:
+                child = node.children[san] = OpeningNode(node.moves + (san,))
+                self.nodes[white, child.moves] = child
+            child.add(perf, points)
+            node = child
+
+        eco = game.headers.get('ECO', '?')
+        rollup = self.ecos.get((white, eco))
+        if rollup is None:
+            rollup = self.ecos[white, eco] = OpeningNode()
+        rollup.add(perf, points)
+
+    def lookup(self, line, white):
+        """Node for a line such as '1.e4 c5 2.Nf3' played with the user as white or black, or None."""
+        moves = clocks.parse_moves(line) if isinstance(line, str) else line
+        return self.nodes.get((white, tuple(moves)))
+
+    def eco_stats(self, white):
+        """(ECO code, node) pairs for the user's color, most played first."""
+        return sorted(((eco, node) for (is_white, eco), node in self.ecos.items() if is_white == white),
+                      key=lambda item: (-item[1].games, item[0]))
+
+
+def build(games, username, plies=DEFAULT_PLIES):
+    trie = OpeningTrie(plies)
+    for game in games:
+        trie.add_game(game, username)
+    return trie
+
+def format_node(name, node):
+    return f'{name:<10} {node.games:>7} {100 * node.score.mean:>6.1f}% {node.perf.mean:>7.0f}'
+
+def print_stats(trie, line=''):
+    for white, color in ((True, 'white'), (False, 'black')):
+        if not trie.roots[white].games:
+            continue
+        print(f'\nAs {color}:')
+        print(f'{"ECO":<10} {"games":>7} {"score":>7} {"perf":>7}')
+        for eco, node in trie.eco_stats(white):
+            print(format_node(eco, node))
+
+        node = trie.lookup(line, white)
+        if node is None:
+            print(f'\nNo games as {color} after {line}')
+            continue
+        print(f'\nAfter {line or "the start"} ({node.games} games, score {100 * node.score.mean:.1f}%, perf {node.perf.mean:.0f}):')
+        print(f'{"move":<10} {"games":>7} {"score":>7} {"perf":>7}')
+        for san, child in sorted(node.children.items(), key=lambda item: -item[1].games):
+            print(format_node(san, child))
@@ -0,0 +1,268 @@
+"""
+Opening, indexing and partial reading of PGN archives, so scripts can read just the games they need.
+
+PGNs ending in .gz or .zst are compressed and decompressed transparently. Offsets always refer to the
+uncompressed stream; only plain files are memory mapped.
+"""
+
+import chess.pgn
+import clocks
+import csv
+import gzip
+import io
+import json
+import mmap
+import os
+import zlib
+
+INDEX_HEADERS = ('UTCDate', 'UTCTime', 'TimeControl', 'White', 'Black', 'WhiteElo', 'BlackElo', 'Result', 'Link')
+# Bytes at the end of the indexed region used to tell an append from a rewrite
+INDEX_CHECK_BYTES = 4096
+CHUNK_SIZE = 1 << 16
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+
+class IndexedGame:
+    """Byte range and key headers of one game, with the same offset/length/headers fields as clocks.ScannedGame."""
+    __slots__ = ('offset', 'length', 'headers')
+
+    def __init__(self, offset, length, headers):
+        self.offset = offset
+        self.length = length
+        self.headers = headers
+
+
+def compression_of(pgnfile):
+    return COMPRESSIONS.get(os.path.splitext(pgnfile)[1])
+
+def find_pgn(pgnfile):
+    """pgnfile, or a compressed copy of it (pgnfile.zst or pgnfile.gz) if only that exists."""
+    for candidate in (pgnfile, f'{pgnfile}.zst', f'{pgnfile}.gz'):
+        if os.path.exists(candidate):
+            return candidate
+    return pgnfile
+
+def open_pgn(pgnfile, mode='r', compression=None):
+    """Opens a PGN for reading ('r', 'rb') or writing ('w', 'a', ...), compressed according to its extension
+    unless compression ('gzip', 'zstd' or None) says otherwise."""
+    compression = compression or compression_of(pgnfile)
+    text = 'b' not in mode
+    if compression == 'gzip':
+        return gzip.open(pgnfile, mode if not text else mode.rstrip('t') + 't', encoding='utf-8' if text else None)
+    if compression == 'zstd':
+        import zstandard
+        if mode.startswith('r'):
+            f = io.BufferedReader(ZstdReader(pgnfile), CHUNK_SIZE)
+            return io.TextIOWrapper(f, encoding='utf-8') if text else f
+        return zstandard.open(pgnfile, mode.rstrip('t') + ('' if not text else 't'), encoding='utf-8' if text else None)
+    return open(pgnfile, mode, encoding='utf-8') if text else open(pgnfile, mode)
+
+
+class ZstdReader(io.RawIOBase):
+    """Decompressing reader for a .zst file that can seek like gzip: forward by skipping, backward by restarting."""
+
+    def __init__(self, pgnfile):
+        self.pgnfile = pgnfile
+        self.raw, self.stream, self.pos = None, None, 0
+        self.restart()
+
+    def restart(self):
+        import zstandard
+        self.close_stream()
+        self.raw = open(self.pgnfile, 'rb')
+        self.stream = zstandard.ZstdDecompressor().stream_reader(self.raw, read_across_frames=True)
+        self.pos = 0
+
+    def close_stream(self):
+        if self.stream:
+            self.stream.close()
+            self.raw.close()
+
+    def close(self):
+        self.close_stream()
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Can only seek from the start or current position of a zstd stream.')
+        if offset < self.pos:
+            self.restart()
+        while self.pos < offset:
+            skipped = len(self.stream.read(min(offset - self.pos, CHUNK_SIZE)))
+            if not skipped:
+                break
+            self.pos += skipped
+        return self.pos
+
+
+class PlyPositions:
+    """Headers of one game, with the board and clock (tenths of a second, -1 if missing) at each requested ply it reached."""
+    __slots__ = ('headers', 'boards', 'clocks', 'plies')
+
+    def __init__(self, headers, boards, clocks, plies):
+        self.headers = headers
+        self.boards = boards
+        self.clocks = clocks
+        self.plies = plies
+
+
+class PlyVisitor(chess.pgn.BaseVisitor):
+    """Records positions at the requested plies. Variations and every move after the last requested ply are
+    tokenized but not parsed or played on a board."""
+
+    def __init__(self, plies):
+        self.wanted = frozenset(plies)
+        self.last = max(self.wanted)
+
+    def begin_game(self):
+        self.headers = chess.pgn.Headers()
+        self.boards, self.clocks = {}, {}
+        self.ply, self.done = 0, False
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def begin_parse_san(self, board, san):
+        if self.ply >= self.last:
+            self.done = True
+            return chess.pgn.SKIP
+        self.ply += 1
+
+    def visit_board(self, board):
+        if not self.done and self.ply in self.wanted and self.ply not in self.boards:
+            self.boards[self.ply] = board.copy(stack=False)
+            self.clocks[self.ply] = -1
+
+    def visit_comment(self, comment):
+        if not self.done and self.ply in self.clocks:
+            self.clocks[self.ply] = clocks.parse_clock(comment)
+
+    def handle_error(self, error):
+        # Like chess.pgn.GameBuilder, keep going; the parser skips the rest of the line
+        self.done = True
+
+    def result(self):
+        return PlyPositions(self.headers, self.boards, self.clocks, self.ply)
+
+
+def read_plies(pgn, plies):
+    """Yields a PlyPositions for every game in a PGN opened in text mode."""
+    while (game := chess.pgn.read_game(pgn, Visitor=lambda: PlyVisitor(plies))) is not None:
+        yield game
+
+def read_game_plies(pgn, game, plies):
+    """PlyPositions for the game behind an IndexedGame, clocks.ScannedGame or gamestore.StoredGame."""
+    pgn.seek(game.offset)
+    return chess.pgn.read_game(pgn, Visitor=lambda: PlyVisitor(plies))
+
+def index_path(pgnfile):
+    return f'{pgnfile}.idx'
+
+def region_checksum(f, size):
+    f.seek(max(0, size - INDEX_CHECK_BYTES))
+    return zlib.crc32(f.read(min(size, INDEX_CHECK_BYTES)))
+
+def read_index(f):
+    """Yields the IndexedGames of an index file opened past its meta line."""
+    for row in csv.reader(f, delimiter='\t'):
+        yield IndexedGame(int(row[0]), int(row[1]), dict(zip(INDEX_HEADERS, row[2:])))
+
+def index_row(entry):
+    return [entry.offset, entry.length] + [entry.headers.get(name, '') for name in INDEX_HEADERS]
+
+def index_games(pgnfile):
+    """Yields the IndexedGames of pgnfile in file order, only scanning games appended since the index was written.
+
+    Entries are streamed rather than collected, so a caller that keeps something smaller per game never holds every
+    header dict at once. An updated index is written alongside and only replaces the old one if iteration finishes.
+    """
+    path = index_path(pgnfile)
+    size = os.path.getsize(pgnfile)
+    with open(pgnfile, 'rb') as raw:
+        checksum = region_checksum(raw, size)
+        meta = None
+        if os.path.exists(path):
+            with open(path, newline='') as f:
+                meta = json.loads(f.readline())
+            if meta['size'] > size or region_checksum(raw, meta['size']) != meta['checksum']:
+                # The file was rewritten rather than appended to
+                meta = None
+    if meta is not None and meta['size'] == size:
+        with open(path, newline='') as f:
+            f.readline()
+            yield from read_index(f)
+        return
+
+    tmp = f'{path}.tmp'
+    try:
+        with open(tmp, 'w', newline='') as out:
+            out.write(json.dumps({'size': size, 'checksum': checksum}) + '\n')
+            writer = csv.writer(out, delimiter='\t')
+            end = 0
+            if meta is not None:
+                with open(path, newline='') as f:
+                    f.readline()
+                    for entry in read_index(f):
+                        writer.writerow(index_row(entry))
+                        end = entry.offset + entry.length
+                        yield entry
+            # Offsets are in the uncompressed stream, so resume where the last indexed game ended
+            with open_pgn(pgnfile, 'rb') as f:
+                f.seek(end)
+                for game in clocks.scan_games(f):
+                    entry = IndexedGame(game.offset, game.length, {name: game.headers.get(name, '') for name in INDEX_HEADERS})
+                    writer.writerow(index_row(entry))
+                    yield entry
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def update_index(pgnfile):
+    """Returns the IndexedGames of pgnfile in file order as a list (see index_games)."""
+    return list(index_games(pgnfile))
+
+def iter_indexed(pgnfile, entries):
+    """Yields a clocks.ScannedGame for each IndexedGame, reading only those games (from a memory map of a plain PGN)."""
+    if not entries:
+        return
+    if compression_of(pgnfile):
+        # Entries are in file order, so this only ever seeks forward through the stream
+        with open_pgn(pgnfile, 'rb') as f:
+            for entry in entries:
+                f.seek(entry.offset)
+                for game in clocks.scan_games(io.BytesIO(f.read(entry.length))):
+                    game.offset = entry.offset
+                    yield game
+        return
+    with open(pgnfile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for entry in entries:
+            for game in clocks.scan_games(io.BytesIO(mm[entry.offset:entry.offset + entry.length])):
+                game.offset = entry.offset
+                yield game
+
+def scan_pgn(pgnfile, start=0, end=None):
+    """Yields a clocks.ScannedGame for every game of a plain or compressed PGN."""
+    with open_pgn(pgnfile, 'rb') as f:
+        f.seek(start)
+        yield from clocks.scan_games(f, end)
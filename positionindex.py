@@ -0,0 +1,176 @@
+"""positionindex
+Finds every game in a PGN archive that reached a position, by any move order, for preparing against an opponent.
+
+The index is a SQLite table from the Zobrist hash of each position to the game and ply where it occurred. It is
+built once per PGN and then brought up to date on every run. Only games that are new since the last run are
+replayed, even though gamegrab rewrites the whole file newest-first, because games are matched up by their Link.
+
+Usage:
+  positionindex.py [--db=DB] [--fen=FEN] [--limit=N] [--profile] [--trace=FILE] PGNFILE [MOVES]
+  positionindex.py (-h | --help)
+
+Options:
+  --db=DB       Index to use (defaults to PGNFILE.positions.db).
+  --fen=FEN     Position to look up, instead of MOVES played from the start.
+  --limit=N     Show at most N of the matching games (default 50).
+  --profile     Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE  Also write a Chrome trace event JSON of the run to FILE.
+  -h --help     Show this screen.
+
+Arguments:
+  PGNFILE       PGN archive to index
+  MOVES         Moves leading to the position, e.g. "1.e4 c5 2.Nf3 d6"
+"""
+
+from docopt import docopt
+import chess
+import chess.pgn
+import chess.polyglot
+import clocks
+import os
+import pgnio
+import profiling
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS games (id INTEGER PRIMARY KEY, link TEXT UNIQUE, offset INTEGER);
+CREATE TABLE IF NOT EXISTS positions (hash INTEGER, game INTEGER, ply INTEGER, PRIMARY KEY (hash, game, ply)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS positions_game ON positions (game);
+'''
+# Games are inserted in batches of this many to bound memory on large archives
+BATCH_GAMES = 1000
+DEFAULT_LIMIT = 50
+
+def default_db(pgnfile):
+    return f'{pgnfile}.positions.db'
+
+def position_hash(board):
+    # SQLite integers are signed 64-bit
+    h = chess.polyglot.zobrist_hash(board)
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+def game_key(game):
+    # Links identify chess.com games wherever they end up in the file; other games only by where they are
+    return game.headers.get('Link') or f'offset:{game.offset}'
+
+def game_positions(game):
+    """(hash, ply) of the start position and each position of the mainline, stopping at an illegal move."""
+    board = chess.Board(game.headers['FEN']) if 'FEN' in game.headers else chess.Board()
+    positions = [(position_hash(board), 0)]
+    for ply, san in enumerate(game.moves(), 1):
+        try:
+            board.push_san(san)
+        except ValueError:
+            break
+        positions.append((position_hash(board), ply))
+    return positions
+
+def connect(db):
+    conn = sqlite3.connect(db)
+    conn.executescript(SCHEMA)
+    return conn
+
+def update(pgnfile, db=None):
+    """Brings the index of pgnfile up to date and returns the number of games replayed."""
+    conn = connect(db or default_db(pgnfile))
+    meta = dict(conn.execute('SELECT key, value FROM meta'))
+    size = os.path.getsize(pgnfile)
+    with open(pgnfile, 'rb') as raw:
+        if meta.get('size') == size and meta.get('checksum') == pgnio.region_checksum(raw, size):
+            conn.close()
+            return 0
+        appended = 'size' in meta and meta['size'] < size and pgnio.region_checksum(raw, meta['size']) == meta['checksum']
+        checksum = pgnio.region_checksum(raw, size)
+
+    known = dict(conn.execute('SELECT link, id FROM games'))
+    seen, moved, batch, replayed = set(), [], [], 0
+
+    def flush():
+        for game in batch:
+            game_id = conn.execute('INSERT INTO games (link, offset) VALUES (?, ?)', (game_key(game), game.offset)).lastrowid
+            conn.executemany('INSERT OR IGNORE INTO positions VALUES (?, ?, ?)', ((h, game_id, ply) for h, ply in game_positions(game)))
+        batch.clear()
+
+    with conn:
+        # An appended file only needs the new games; anything else is rescanned, replaying only unknown games
+        for game in profiling.timed(pgnio.scan_pgn(pgnfile, meta.get('end', 0) if appended else 0), 'pgn parse'):
+            key = game_key(game)
+            meta['end'] = game.offset + game.length
+            if key in known:
+                seen.add(known[key])
+                moved.append((game.offset, known[key]))
+                continue
+            known[key] = None
+            batch.append(game)
+            replayed += 1
+            profiling.progress('games')
+            if len(batch) >= BATCH_GAMES:
+                with profiling.stage('analysis'):
+                    flush()
+        with profiling.stage('analysis'):
+            flush()
+        conn.executemany('UPDATE games SET offset = ? WHERE id = ?', moved)
+        if not appended:
+            # Games no longer in the file are dropped in one statement each, by the positions_game index
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS gone (id INTEGER PRIMARY KEY)')
+            conn.execute('DELETE FROM gone')
+            conn.executemany('INSERT INTO gone VALUES (?)',
+                             ((game_id,) for game_id in known.values() if game_id is not None and game_id not in seen))
+            conn.execute('DELETE FROM positions WHERE game IN (SELECT id FROM gone)')
+            conn.execute('DELETE FROM games WHERE id IN (SELECT id FROM gone)')
+        meta.update(size=size, checksum=checksum)
+        conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', meta.items())
+    conn.close()
+    return replayed
+
+def find(db, board):
+    """(offset, ply) of every game that reached board's position, in file order."""
+    conn = connect(db)
+    rows = conn.execute('SELECT games.offset, positions.ply FROM positions JOIN games ON games.id = positions.game '
+                        'WHERE positions.hash = ? ORDER BY games.offset, positions.ply', (position_hash(board),)).fetchall()
+    conn.close()
+    return rows
+
+def board_after(moves):
+    board = chess.Board()
+    for san in clocks.parse_moves(moves):
+        board.push_san(san)
+    return board
+
+def main(arguments):
+    pgnfile = arguments['PGNFILE']
+    db = arguments.get('--db') or default_db(pgnfile)
+    limit = int(arguments.get('--limit') or DEFAULT_LIMIT)
+
+    replayed = update(pgnfile, db)
+    if replayed:
+        print(f'Indexed {replayed} new games in {db}')
+
+    if arguments.get('--fen'):
+        board = chess.Board(arguments['--fen'])
+    elif arguments.get('MOVES'):
+        board = board_after(arguments['MOVES'])
+    else:
+        return
+
+    matches = find(db, board)
+    games = len({offset for offset, ply in matches})
+    print(f'{games} games reached {board.fen()}')
+    with pgnio.open_pgn(pgnfile) as pgn:
+        shown = set()
+        for offset, ply in matches:
+            if offset in shown:
+                continue
+            if len(shown) >= limit:
+                print('...')
+                break
+            shown.add(offset)
+            pgn.seek(offset)
+            h = chess.pgn.read_headers(pgn)
+            print(f'{h.get("UTCDate", "?")} {h.get("White")} - {h.get("Black")} {h.get("Result")} at ply {ply} {h.get("Link", "")}')
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    with profiling.session(arguments):
+        main(arguments)
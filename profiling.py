@@ -0,0 +1,158 @@
+"""
+Opt-in instrumentation shared by the scripts: time spent per stage, counters, periodic progress and an optional
+trace file.
+
+Everything is a cheap no-op until enable() is called, which the scripts do for --profile or --trace=FILE.
+Stages timed on several threads at once (downloads, engine searches) add up to more than the wall time. Work done
+in --jobs worker processes is not recorded; only the parent's waiting shows up.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import sys
+import threading
+import time
+
+# Per-event trace entries beyond this are dropped (and counted) to bound memory on huge archives
+MAX_TRACE_EVENTS = 200000
+PROGRESS_INTERVAL = 5.0
+
+enabled = False
+tracing = False
+lock = threading.Lock()
+started = 0.0
+stages = {}
+counters = {}
+events = []
+dropped_events = 0
+last_progress = 0.0
+
+
+def enable(trace=False):
+    global enabled, tracing, started, last_progress
+    enabled, tracing = True, bool(trace)
+    started = last_progress = time.perf_counter()
+
+def add(name, n=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+def log(message):
+    """Prints message only while profiling, e.g. each archive url as it is requested."""
+    if enabled:
+        print(message, file=sys.stderr, flush=True)
+
+def record(name, start, seconds, args=None):
+    global dropped_events
+    with lock:
+        total = stages.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+        if tracing:
+            if len(events) < MAX_TRACE_EVENTS:
+                event = {'name': name, 'ph': 'X', 'ts': (start - started) * 1e6, 'dur': seconds * 1e6,
+                         'pid': os.getpid(), 'tid': threading.get_ident()}
+                if args:
+                    event['args'] = args
+                events.append(event)
+            else:
+                dropped_events += 1
+
+
+class stage:
+    """Times a with-block as one call of the named stage."""
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if enabled:
+            record(self.name, self.start, time.perf_counter() - self.start, self.args)
+
+
+def timed(iterable, name):
+    """Yields from iterable, timing each step as the named stage (e.g. PGN parsing inside a game loop)."""
+    if not enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            record(name, start, time.perf_counter() - start)
+        yield item
+
+def progress(name, n=1):
+    """Counts n items of name and every few seconds prints how many have been done and how fast."""
+    global last_progress
+    if not enabled:
+        return
+    add(name, n)
+    now = time.perf_counter()
+    if now - last_progress >= PROGRESS_INTERVAL:
+        last_progress = now
+        done = counters[name]
+        print(f'[{now - started:7.1f}s] {done} {name} ({done / (now - started):.1f}/sec)', file=sys.stderr, flush=True)
+
+def hit_rate(hits, misses):
+    total = counters.get(hits, 0) + counters.get(misses, 0)
+    return f'{100 * counters.get(hits, 0) / total:.1f}%' if total else None
+
+def summary():
+    wall = time.perf_counter() - started
+    derived = {'wall seconds': wall}
+    if counters.get('games'):
+        derived['games/sec'] = counters['games'] / wall
+    if counters.get('bytes fetched'):
+        derived['MB fetched'] = counters['bytes fetched'] / 1e6
+    if counters.get('engine nodes') and stages.get('engine search'):
+        derived['engine nodes/sec'] = counters['engine nodes'] / stages['engine search'][0]
+    for cache in ('archive', 'eval'):
+        if rate := hit_rate(f'{cache} cache hits', f'{cache} cache misses'):
+            derived[f'{cache} cache hit rate'] = rate
+    return {'stages': {name: {'seconds': s, 'calls': n} for name, (s, n) in stages.items()}, 'counters': dict(counters), 'derived': derived}
+
+def report(out=sys.stderr):
+    data = summary()
+    wall = data['derived']['wall seconds']
+    print(f'\n{"stage":<20} {"seconds":>10} {"calls":>10} {"% wall":>7}', file=out)
+    for name, s in sorted(data['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f'{name:<20} {s["seconds"]:>10.3f} {s["calls"]:>10} {100 * s["seconds"] / wall:>6.1f}%', file=out)
+    for name, value in list(data['counters'].items()) + list(data['derived'].items()):
+        print(f'{name}: {value:.1f}' if isinstance(value, float) else f'{name}: {value}', file=out)
+    out.flush()
+
+def write_trace(path):
+    """Writes the recorded stages in Chrome trace event format (chrome://tracing, Perfetto), with the summary."""
+    with lock:
+        data = {'traceEvents': list(events), 'displayTimeUnit': 'ms', 'otherData': summary() | {'dropped events': dropped_events}}
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+@contextmanager
+def session(arguments):
+    """Profiles a script's main() if its docopt arguments ask for --profile or --trace=FILE."""
+    trace = arguments.get('--trace')
+    if not (arguments.get('--profile') or trace):
+        yield
+        return
+    enable(trace)
+    try:
+        yield
+    finally:
+        report()
+        if trace:
+            write_trace(trace)
@@ -0,0 +1,159 @@
+"""
+Compact in-memory game records for very large histories.
+
+GameRecords keeps one row of a NumPy structured array per game: UTC timestamp, player ids, ratings, result, time
+control id, the game's byte range in its PGN and a slice of one clock buffer shared by all games. Player names and
+time controls are stored once each, so a game costs 48 bytes plus 4 per ply with clocks, where a header dict
+alone costs kilobytes. Whole-history analyses use the columns directly; record(i) gives a view that looks like a
+ScannedGame for the per-game helpers (get_user_perf, ClockTimeline.from_game, ...).
+"""
+
+from array import array
+import calendar
+import numpy as np
+
+DTYPE = np.dtype([
+    ('offset', np.int64), ('length', np.int32), ('timestamp', np.int64),
+    ('white', np.int32), ('black', np.int32), ('white_elo', np.int16), ('black_elo', np.int16),
+    ('result', np.int8), ('time_control', np.int16), ('user_white', np.bool_),
+    ('clock_start', np.int64), ('clock_count', np.int32),
+])
+# Results from white's point of view; UNKNOWN for unfinished games
+RESULTS = {'1-0': 1, '1/2-1/2': 0, '0-1': -1}
+RESULT_NAMES = {code: name for name, code in RESULTS.items()}
+UNKNOWN = -2
+# Rows are converted to arrays this many at a time while building, so Python tuples never pile up
+CHUNK_GAMES = 1 << 16
+
+
+def to_timestamp(utc_date, utc_time):
+    """Seconds since the epoch from PGN UTCDate and UTCTime headers, or 0 if they are missing."""
+    try:
+        y, m, d = map(int, utc_date.split('.'))
+        hh, mm, ss = map(int, utc_time.split(':'))
+    except ValueError:
+        return 0
+    return calendar.timegm((y, m, d, hh, mm, ss))
+
+
+class GameRecord:
+    """One row of GameRecords with the offset/length/headers/clocks/plies interface of clocks.ScannedGame."""
+    __slots__ = ('records', 'index')
+
+    def __init__(self, records, index):
+        self.records = records
+        self.index = index
+
+    @property
+    def row(self):
+        return self.records.games[self.index]
+
+    @property
+    def offset(self):
+        return int(self.row['offset'])
+
+    @property
+    def length(self):
+        return int(self.row['length'])
+
+    @property
+    def clocks(self):
+        row = self.row
+        game_clocks = array('i')
+        game_clocks.frombytes(self.records.clocks[row['clock_start']:row['clock_start'] + row['clock_count']].tobytes())
+        return game_clocks
+
+    @property
+    def plies(self):
+        return int(self.row['clock_count'])
+
+    @property
+    def headers(self):
+        row, records = self.row, self.records
+        timestamp = row['timestamp'].astype('datetime64[s]').item()
+        headers = {
+            'White': records.names[row['white']], 'Black': records.names[row['black']],
+            'WhiteElo': str(row['white_elo']), 'BlackElo': str(row['black_elo']),
+            'Result': RESULT_NAMES.get(int(row['result']), '*'), 'TimeControl': records.time_controls[row['time_control']],
+            'UTCDate': timestamp.strftime('%Y.%m.%d'), 'UTCTime': timestamp.strftime('%H:%M:%S'),
+        }
+        if self.index in records.fens:
+            headers['FEN'] = records.fens[self.index]
+        return headers
+
+
+class GameRecords:
+    """A user's games as columns. Build with from_games(); filter with select()."""
+    __slots__ = ('username', 'games', 'clocks', 'names', 'time_controls', 'fens')
+
+    def __init__(self, username, games, clocks, names, time_controls, fens):
+        self.username = username
+        self.games = games
+        self.clocks = clocks
+        self.names = names
+        self.time_controls = time_controls
+        # Start positions of the rare games that do not start from the initial position, by row
+        self.fens = fens
+
+    @classmethod
+    def from_games(cls, games, username):
+        """Records of ScannedGames, StoredGames, IndexedGames or GameRecords, in the order given.
+        Games without a clocks attribute get no clocks."""
+        name_ids, tc_ids, fens = {}, {}, {}
+        clock_buffer = array('i')
+        chunks, rows = [], []
+        user = username.lower()
+        for index, game in enumerate(games):
+            h = game.headers
+            game_clocks = getattr(game, 'clocks', None) or ()
+            white, black = h.get('White', '?'), h.get('Black', '?')
+            rows.append((
+                game.offset, getattr(game, 'length', 0), to_timestamp(h.get('UTCDate', ''), h.get('UTCTime', '')),
+                name_ids.setdefault(white, len(name_ids)), name_ids.setdefault(black, len(name_ids)),
+                int(h.get('WhiteElo') or 0), int(h.get('BlackElo') or 0), RESULTS.get(h.get('Result'), UNKNOWN),
+                tc_ids.setdefault(h.get('TimeControl', '-'), len(tc_ids)), white.lower() == user,
+                len(clock_buffer), len(game_clocks),
+            ))
+            clock_buffer.extend(game_clocks)
+            if 'FEN' in h:
+                fens[index] = h['FEN']
+            if len(rows) >= CHUNK_GAMES:
+                chunks.append(np.array(rows, dtype=DTYPE))
+                rows.clear()
+        chunks.append(np.array(rows, dtype=DTYPE))
+        return cls(username, np.concatenate(chunks), np.frombuffer(clock_buffer, dtype=np.int32),
+                   list(name_ids), list(tc_ids), fens)
+
+    def __len__(self):
+        return len(self.games)
+
+    def __iter__(self):
+        return (GameRecord(self, i) for i in range(len(self.games)))
+
+    def record(self, index):
+        return GameRecord(self, index)
+
+    def select(self, mask):
+        """Records of the games where mask (a boolean array or index array) is set, sharing this clock buffer."""
+        indexes = np.arange(len(self.games))[mask]
+        fens = {new: self.fens[old] for new, old in enumerate(indexes) if old in self.fens}
+        return GameRecords(self.username, self.games[indexes], self.clocks, self.names, self.time_controls, fens)
+
+    def time_control_is(self, *time_controls):
+        ids = [i for i, tc in enumerate(self.time_controls) if tc in time_controls]
+        return np.isin(self.games['time_control'], ids)
+
+    def user_ratings(self):
+        return np.where(self.games['user_white'], self.games['white_elo'], self.games['black_elo']).astype(np.int64)
+
+    def opponent_ratings(self):
+        return np.where(self.games['user_white'], self.games['black_elo'], self.games['white_elo']).astype(np.int64)
+
+    def user_scores(self):
+        """+1, 0 or -1 for each game from the user's point of view (UNKNOWN results count as 0)."""
+        results = np.where(self.games['result'] == UNKNOWN, 0, self.games['result']).astype(np.int64)
+        return np.where(self.games['user_white'], results, -results)
+
+    def perfs(self):
+        """Performance rating of every game, as get_user_perf computes it one game at a time."""
+        return self.opponent_ratings() + 400 * self.user_scores()
@@ -0,0 +1,162 @@
+"""
+Mergeable streaming statistics.
+
+Each accumulator can absorb values one at a time, be merged with another accumulator of the same kind (from a
+worker process or an earlier run), and round-trip through a JSON-friendly dict.
+"""
+
+import json
+import math
+import os
+
+
+class Moments:
+    """Count, exact sum, mean and variance. The sum is kept exactly so means match a plain sum()/len()."""
+    __slots__ = ('count', 'total', 'm2')
+
+    def __init__(self, count=0, total=0, m2=0.0):
+        self.count = count
+        self.total = total
+        self.m2 = m2
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else math.nan
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    def add(self, x):
+        old_mean = self.mean if self.count else 0
+        self.count += 1
+        self.total += x
+        self.m2 += (x - old_mean) * (x - self.mean)
+
+    def add_many(self, xs):
+        for x in xs:
+            self.add(x)
+
+    def merge(self, other):
+        if other.count:
+            if self.count:
+                delta = other.mean - self.mean
+                self.m2 += other.m2 + delta * delta * self.count * other.count / (self.count + other.count)
+            else:
+                self.m2 = other.m2
+            self.count += other.count
+            self.total += other.total
+        return self
+
+    def to_dict(self):
+        return {'type': 'Moments', 'count': self.count, 'total': self.total, 'm2': self.m2}
+
+
+class Rate:
+    """Fraction of observations that were hits, e.g. premoves among all moves."""
+    __slots__ = ('hits', 'total')
+
+    def __init__(self, hits=0, total=0):
+        self.hits = hits
+        self.total = total
+
+    @property
+    def rate(self):
+        return self.hits / self.total if self.total else math.nan
+
+    def add(self, hit):
+        self.hits += bool(hit)
+        self.total += 1
+
+    def merge(self, other):
+        self.hits += other.hits
+        self.total += other.total
+        return self
+
+    def to_dict(self):
+        return {'type': 'Rate', 'hits': self.hits, 'total': self.total}
+
+
+class QuantileSketch:
+    """Approximate quantiles of non-negative values in fixed memory.
+
+    Values are counted in logarithmic buckets, so any quantile is within relative_accuracy of a true value.
+    Negative values (e.g. a move that gained increment) count as 0 and values above max_value as max_value.
+    """
+    __slots__ = ('relative_accuracy', 'max_value', 'zeros', 'counts')
+
+    def __init__(self, relative_accuracy=0.01, max_value=36000, zeros=0, counts=None):
+        self.relative_accuracy = relative_accuracy
+        self.max_value = max_value
+        self.zeros = zeros
+        self.counts = counts or [0] * (self.bucket(max_value) + 1)
+
+    @property
+    def gamma(self):
+        return (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+
+    def bucket(self, x):
+        return max(0, math.ceil(math.log(x) / math.log(self.gamma)))
+
+    @property
+    def count(self):
+        return self.zeros + sum(self.counts)
+
+    def add(self, x):
+        if x <= 0:
+            self.zeros += 1
+        else:
+            self.counts[self.bucket(min(x, self.max_value))] += 1
+
+    def quantile(self, q):
+        rank = q * (self.count - 1)
+        if self.count == 0:
+            return math.nan
+        if rank < self.zeros:
+            return 0
+        seen = self.zeros
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen > rank:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        return self.max_value
+
+    def merge(self, other):
+        if (other.relative_accuracy, other.max_value) != (self.relative_accuracy, self.max_value):
+            raise ValueError('Can only merge sketches with the same accuracy and range.')
+        self.zeros += other.zeros
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        return self
+
+    def to_dict(self):
+        return {'type': 'QuantileSketch', 'relative_accuracy': self.relative_accuracy, 'max_value': self.max_value,
+                'zeros': self.zeros, 'counts': self.counts}
+
+
+TYPES = {cls.__name__: cls for cls in (Moments, Rate, QuantileSketch)}
+
+def from_dict(d):
+    d = dict(d)
+    return TYPES[d.pop('type')](**d)
+
+def merge_all(many):
+    """Merges dicts of named accumulators key by key."""
+    merged = {}
+    for accumulators in many:
+        for name, acc in accumulators.items():
+            if name in merged:
+                merged[name].merge(acc)
+            else:
+                merged[name] = from_dict(acc.to_dict())
+    return merged
+
+def save(path, accumulators):
+    # Written to a temporary file first, so a file that is updated in place is never left half written
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({name: acc.to_dict() for name, acc in accumulators.items()}, f)
+    os.replace(tmp, path)
+
+def load(path):
+    with open(path) as f:
+        return {name: from_dict(d) for name, d in json.load(f).items()}
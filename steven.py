@@ -1,50 +1,93 @@
-"""
+"""steven
 Generate a list of game headers, clock difference, and eval at move 20 for a PGN archive
+
+Usage:
+  steven.py [--store=DB] [--engine=PATH] [--engines=N] [--threads=N] [--hash=MB] [--eval-cache=FILE] [--budget=SEC] [--min-depth=D] [--profile] [--trace=FILE] [PGNFILE]
+  steven.py (-h | --help)
+
+Options:
+  --store=DB        Read games from a gamestore database, skipping games too short to reach move 20.
+  --engine=PATH     UCI engine binary (defaults to $STOCKFISH or stockfish on the PATH).
+  --engines=N       Number of engine processes to run in parallel [default: 1]
+  --threads=N       Threads per engine [default: 4]
+  --hash=MB         Hash size per engine in MB [default: 1000]
+  --eval-cache=FILE Reuse evaluations stored in FILE [default: .eval_cache.db]
+  --budget=SEC      Spend about SEC seconds in total: search every position to --min-depth, then deepen those near
+                    an eval bucket boundary (see times.EVALS) towards depth 20, and print each final depth.
+  --min-depth=D     Depth of the first search of every position with --budget [default: 8]
+  --profile         Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE      Also write a Chrome trace event JSON of the run to FILE.
+  -h --help         Show this screen.
+
+Arguments:
+  PGNFILE       PGN archive to analyze, optionally .gz or .zst compressed (defaults to ToddBryant.pgn)
 """
 
+from docopt import docopt
+from enginepool import DEFAULT_ENGINE, EnginePool, analyse_within, cp_boundaries, in_order
+from evalcache import DEFAULT_EVAL_CACHE, EvalCache
 import chess
 import chess.pgn
 import datetime
-import re
-
-pgn = open('ToddBryant.pgn')
-
-STOCKFISH = chess.engine.SimpleEngine.popen_uci("stockfish")
-STOCKFISH.configure({"Threads": 4, "Hash": 1000})
-
-game_cnt = 0
-clock_regex = re.compile(r'.*%clk 0:([0-9]*):([0-9\\.]*)')
-while game := chess.pgn.read_game(pgn):
-    node = game.root()
-    white_rating = int(game.headers['WhiteElo'])
-    black_rating = int(game.headers['BlackElo'])
-    if game.headers['Result'] == '1-0':
-        result = 1
-    elif game.headers['Result'] == '0-1':
-        result = 0
+import gamestore
+import pgnio
+import profiling
+import times
+
+def main(arguments):
+    store = arguments.get('--store')
+    pgn = pgnio.open_pgn(gamestore.get_pgnfile(store) if store else arguments.get('PGNFILE') or 'ToddBryant.pgn')
+    engine = arguments.get('--engine') or DEFAULT_ENGINE
+    engines = int(arguments.get('--engines') or 1)
+    threads = int(arguments.get('--threads') or 4)
+    hash_mb = int(arguments.get('--hash') or 1000)
+    cache = EvalCache(arguments.get('--eval-cache') or DEFAULT_EVAL_CACHE)
+    budget = float(arguments['--budget']) if arguments.get('--budget') else None
+    min_depth = int(arguments.get('--min-depth') or 8)
+
+    if store:
+        games = (pgnio.read_game_plies(pgn, stored, (39, 40)) for stored in gamestore.query(store, min_plies=40))
     else:
-        result = 0.5
-
-    ply_count = 0
-    while node.next():
-        ply_count += 1
-        prev_node = node
-        node = node.next()
-
-        if ply_count in (39, 40):
-            min, sec = map(float, clock_regex.match(node.comment).groups())
-            time_tenths_sec = min * 600 + sec * 10
-            if ply_count == 39:
-                white_time = time_tenths_sec
+        games = pgnio.read_plies(pgn, (39, 40))
+
+    lines = []
+
+    def positions():
+        # Moves after ply 40 are skipped rather than parsed
+        for game in profiling.timed(games, 'pgn parse'):
+            profiling.progress('games')
+            if 40 not in game.boards:
+                continue
+            white_rating = int(game.headers['WhiteElo'])
+            black_rating = int(game.headers['BlackElo'])
+            if game.headers['Result'] == '1-0':
+                result = 1
+            elif game.headers['Result'] == '0-1':
+                result = 0
             else:
-                black_time = time_tenths_sec
-                # Only count games where there was a 30+ sec time difference
-                #if abs(white_time-black_time) < 300:
-                #    break
-                eval = STOCKFISH.analyse(chess.Board(node.board().fen()), limit=chess.engine.Limit(depth=20))['score']
-                try:
-                    eval = eval.relative.cp/100
-                except:
-                    pass
-                print(f'{game.headers["Link"]} {result} {white_rating} {black_rating} {white_time} {black_time} {eval}')
-    game_cnt += 1
+                result = 0.5
+
+            white_time, black_time = float(game.clocks[39]), float(game.clocks[40])
+            # Only count games where there was a 30+ sec time difference
+            #if abs(white_time-black_time) < 300:
+            #    continue
+            lines.append(f'{game.headers["Link"]} {result} {white_rating} {black_rating} {white_time} {black_time}')
+            yield len(lines) - 1, game.boards[40]
+
+    with EnginePool(engine, engines, threads, hash_mb, cache) as pool:
+        if budget:
+            analysed = sorted(analyse_within(pool, positions(), budget, cp_boundaries(times.EVALS), min_depth, 20).items())
+        else:
+            analysed = in_order(pool.analyse(positions(), chess.engine.Limit(depth=20)))
+        for game_id, info in analysed:
+            eval = info['score']
+            try:
+                eval = eval.relative.cp/100
+            except:
+                pass
+            print(f'{lines[game_id]} {eval} {info["depth"]}' if budget else f'{lines[game_id]} {eval}')
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    with profiling.session(arguments):
+        main(arguments)
@@ -1,14 +1,41 @@
-from chess.engine import Cp, Mate, MateGiven, Limit, SimpleEngine
-import chess.pgn
-import re
+"""times
+Performance in 3 0 games by the gap between the user's and the opponent's clock.
+
+Usage:
+  times.py [--store=DB] [--bin-size=N] [--profile] [--trace=FILE] [USERNAME]
+  times.py (-h | --help)
+
+Options:
+  --store=DB        Read games from a gamestore database instead of USERNAME.pgn.
+  --bin-size=N      Clock grid cell size in tenths of a second [default: 50]
+  --profile         Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE      Also write a Chrome trace event JSON of the run to FILE.
+  -h --help         Show this screen.
+
+Arguments:
+  USERNAME      player whose games to analyze (defaults to ToddBryant)
+"""
+
+from chess.engine import Cp, Mate, MateGiven, Limit
+from docopt import docopt
+from enginepool import DEFAULT_ENGINE, EnginePool, analyse_within, cp_boundaries, in_order
+from evalcache import DEFAULT_EVAL_CACHE, EvalCache
+import clocks
+import gamestore
+import numpy as np
+import pandas as pd
+import pgnio
+import plotly.express as px
+import profiling
+import stats
 
 def add_result(times, perf, results):
     if times not in results:
-        results[times] = {'n': 0, 'perf': 0}
-    n, old_perf = results[times]['n'], results[times]['perf']
+        results[times] = stats.Moments()
+    results[times].add(perf)
 
-    results[times]['perf'] = (old_perf * n + perf) / (n + 1)
-    results[times]['n'] += 1
+def format_result(result):
+    return {'n': result.count, 'perf': result.mean}
 
 DIFFS = (-1200, -600, -300, -150, 150, 300, 600, 1200)
 EVALS = [-MateGiven, -Mate(99), Cp(-500), Cp(-300), Cp(-100), Cp(0), Cp(100), Cp(300), Cp(500), Mate(99), MateGiven]
@@ -29,39 +56,88 @@ def get_user_perf(game, username):
 def is_user_white(game, username):
     return game.headers["White"] == username
 
+class ClockGrid:
+    """Games and summed perf for each (user clock, opponent clock) cell of a fixed grid.
+
+    A game counts once in every cell its clocks pass through, so memory depends only on the grid size.
+    """
+    def __init__(self, max_time=1800, bin_size=50):
+        self.bin_size = bin_size
+        self.bins = max_time // bin_size + 1
+        self.games = np.zeros((self.bins, self.bins), dtype=np.int64)
+        self.perf = np.zeros((self.bins, self.bins), dtype=np.int64)
+
+    def add_game(self, user_times, opp_times, perf):
+        user_bins = np.clip(user_times // self.bin_size, 0, self.bins - 1)
+        opp_bins = np.clip(opp_times // self.bin_size, 0, self.bins - 1)
+        cells = np.unique(user_bins * self.bins + opp_bins)
+        self.games.flat[cells] += 1
+        self.perf.flat[cells] += perf
+
+    def mean_perf(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.games > 0, self.perf / self.games, np.nan)
+
+    def to_frame(self):
+        """Average perf with user clock (seconds, bin start) as rows and opponent clock as columns."""
+        seconds = np.arange(self.bins) * self.bin_size / 10
+        return pd.DataFrame(self.mean_perf(), index=pd.Index(seconds, name='user'), columns=pd.Index(seconds, name='opponent'))
+
+    def to_heatmap(self, title='Performance by clock state'):
+        return px.imshow(self.to_frame(), origin='lower', title=title, labels={'color': 'perf'})
+
+def read_games(username, store=None, **filters):
+    if store:
+        return gamestore.query(store, **filters)
+    return pgnio.scan_pgn(pgnio.find_pgn(f'{username}.pgn'))
+
 def print_results(results):
     for d in DIFFS:
-        print(d, results.get(d, 'No games'))
+        print(d, format_result(results[d]) if d in results else 'No games')
 
 def print_eval_results(results):
     for i, eval in enumerate(EVALS[:-1]):
         result_str = f'[{EVALS[i]}, {EVALS[i+1]}]'
-        print(result_str, results.get(result_str, 'No games'))
+        print(result_str, format_result(results[result_str]) if result_str in results else 'No games')
 
 
-def check_eval(username='ToddBryant'):
-    stockfish = SimpleEngine.popen_uci("/opt/homebrew/bin/stockfish")
+def check_eval(username='ToddBryant', store=None, engine=DEFAULT_ENGINE, engines=1, threads=1, hash_mb=16, eval_cache=DEFAULT_EVAL_CACHE, budget=None):
+    """With a budget (seconds), positions get shallow searches first and only those near an EVALS boundary are
+    deepened up to depth 16, instead of depth 16 for all."""
     results = {}
     game_count = 0 
-
-    with open(f'{username}.pgn') as f:
-        while game := chess.pgn.read_game(f):
-            user_is_white = is_user_white(game, username)
-            perf = get_user_perf(game, username)
-
-            node = game.root()
-
-            move_ctr = 0
-            while node.next() and move_ctr <= 40:
-                node = node.next()
-                move_ctr += 1
-            if move_ctr < 40:
+    perfs = []
+
+    def positions():
+        source = pgnio.open_pgn(gamestore.get_pgnfile(store) if store else pgnio.find_pgn(f'{username}.pgn'))
+        if store:
+            games = (pgnio.read_game_plies(source, game, (40, 41)) for game in gamestore.query(store, min_plies=40))
+        else:
+            games = pgnio.read_plies(source, (40, 41))
+        for game in profiling.timed(games, 'pgn parse'):
+            profiling.progress('games')
+            # Moves after ply 41 are skipped rather than parsed
+            board = game.boards.get(41) or game.boards.get(40)
+            if not board:
                 continue
-
-            # Evaluate the position on move 20
-            eval = stockfish.analyse(node.board(), Limit(depth=16))['score']
+            perfs.append((is_user_white(game, username), get_user_perf(game, username)))
+            yield len(perfs) - 1, board
+
+    cache = EvalCache(eval_cache) if eval_cache else None
+    with EnginePool(engine, engines, threads, hash_mb, cache) as pool:
+        # Evaluate the position on move 20
+        if budget:
+            analysed = sorted(analyse_within(pool, positions(), budget, cp_boundaries(EVALS), max_depth=16).items())
+        else:
+            analysed = in_order(pool.analyse(positions(), Limit(depth=16)))
+        for game_id, info in analysed:
+            user_is_white, perf = perfs[game_id]
+            eval = info['score']
             eval = eval.white() if user_is_white else eval.black()
-            print(eval)
+            if budget:
+                print(eval, f'depth={info["depth"]}')
+            else:
+                print(eval)
 
             for i, level in enumerate(EVALS[:-1]):
                 if EVALS[i] <= eval < EVALS[i+1]:
@@ -71,51 +147,33 @@ def check_eval(username='ToddBryant'):
 
     return results
 
-def main(username='ToddBryant'):
-    diffs = {d: set() for d in DIFFS}
+def main(username='ToddBryant', store=None, bin_size=50):
+    """Returns per-DIFFS results and a ClockGrid of perf by (user clock, opponent clock) for 3 0 games."""
     results = {}
+    grid = ClockGrid(1800, bin_size)
 
-    with open(f'{username}.pgn') as f:
-        while game := chess.pgn.read_game(f):
-            # Only consider 3 0 games
-            if game.headers["TimeControl"] != "180":
-                continue
+    for game in profiling.timed(read_games(username, store, time_controls=('180',)), 'pgn parse'):
+        # Only consider 3 0 games
+        if game.headers["TimeControl"] != "180":
+            continue
 
+        with profiling.stage('analysis'):
             user_is_white = is_user_white(game, username)
             perf = get_user_perf(game, username)
 
-            node = game.root()
-            user_time, opp_time = 1800, 1800
-            add_result((user_time, opp_time), perf, results)
-            clock_regex = re.compile(r'.*%clk 0:([0-9]*):([0-9\\.]*)')
-
-            diffs_found = {d: False for d in DIFFS}
-            while node.next():
-                node = node.next()
-                try:
-                    min, sec = map(float, clock_regex.match(node.comment).groups())
-                except AttributeError:
-                    continue
-
-                time_ds = min * 600 + int(sec * 10)
-
-                white_to_move = not node.turn()
-                if user_is_white and white_to_move:
-                    user_time = time_ds
-                elif not user_is_white and not white_to_move:
-                    user_time = time_ds
-                else:
-                    opp_time = time_ds
-
-                add_result((user_time, opp_time), perf, results)
-                for diff in DIFFS:
-                    if diff < 0 and user_time <= opp_time + diff or diff > 0 and user_time >= opp_time + diff:
-                        if not diffs_found[diff]:
-                            add_result(diff, perf, results)
-                            diffs_found[diff] = True
+            user_times, opp_times = clocks.ClockTimeline.from_game(game).states(user_is_white)
+            grid.add_game(user_times, opp_times, perf)
 
+            gaps = user_times[1:] - opp_times[1:]
+            for diff in DIFFS:
+                if (gaps <= diff).any() if diff < 0 else (gaps >= diff).any():
+                    add_result(diff, perf, results)
+        profiling.progress('games')
 
-    return results
+    return results, grid
 
 if __name__ == '__main__':
-    main()
+    arguments = docopt(__doc__)
+    with profiling.session(arguments):
+        results, grid = main(arguments.get('USERNAME') or 'ToddBryant', arguments.get('--store'), int(arguments.get('--bin-size') or 50))
+    print_results(results)
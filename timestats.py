@@ -1,27 +1,36 @@
 """timestats
 
 Usage:
-  timestats.py [--num_games=NUMGAMES] [--threshold=THRESHOLD] USERNAME
+  timestats.py [--num_games=NUMGAMES] [--threshold=THRESHOLD] [--store=DB] [--jobs=N] [--load-stats=FILE] [--save-stats=FILE] [--profile] [--trace=FILE] USERNAME
   timestats.py (-h | --help)
 
 Options:
   --num_games=NUMGAMES    Only download last n games [default: 10000]
   --threshold=THRESHOLD   Point out moves where more than THRESHOLD sec spent [default: 15]
+  --store=DB              Analyze games from a gamestore database instead of downloading.
+  --jobs=N                Analyze the PGN in N processes [default: 1]
+  --load-stats=FILE       Merge in statistics saved by an earlier run (e.g. over other games).
+  --save-stats=FILE       Save the combined statistics to FILE.
+  --profile               Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE            Also write a Chrome trace event JSON of the run to FILE.
   -h --help               Show this screen.
 
 Arguments:
   USERNAME      username to download games
 """
 
+from concurrent.futures import ProcessPoolExecutor
 from docopt import docopt
 
 
-import chess
-import chess.pgn
+import archivecache
+import clocks
 import datetime
 import gamegrab
-import os
-import re
+import gamestore
+import pgnio
+import profiling
+import stats
 
 def tenths_sec_to_str(time_tenths):
    min = time_tenths // 600
@@ -60,97 +69,117 @@ def get_user_perf(game, username):
 
     return perf
 
-def get_think_times(game, username):
-    clock_regex = re.compile(r'.*%clk 0:([0-9]*):([0-9\\.]*)')
-
-    node = game.root()
-    node.comment = f'{game.headers["Link"]}'
-    comments = False
-    
-    prev_time_tenths_sec = int(game.headers['TimeControl'].split('+')[0]) * 10
-    think_times = []
-    scramble_times = []
-    while node.next():
-        prev_node, node = node, node.next()
-
-        minutes, sec = map(float, clock_regex.match(node.comment).groups())
-        time_tenths_sec = minutes * 600 + sec * 10
-
-        if is_user_to_move(game, node, username):
-            delta, prev_time_tenths_sec = prev_time_tenths_sec - time_tenths_sec, time_tenths_sec
-            think_times.append(delta)
-            if time_tenths_sec < 100 and opp_time_tenths_sec < 100:
-                scramble_times.append(delta)
-        else:
-            opp_time_tenths_sec = time_tenths_sec
-
-    return think_times, scramble_times
+def get_think_times(game, username, timeline=None):
+    """Think times of all the user's moves and of those made with both clocks under 10 seconds, in tenths of a second."""
+    if timeline is None:
+        timeline = clocks.ClockTimeline.from_game(game)
+    user_is_white = is_user_white(game, username)
+    return [delta for ply, delta in timeline.think_times(user_is_white)], timeline.scramble_think_times(user_is_white, 100)
 
 # Returns true if the game ever reached a time scramble, defined as:
 # * Both sides under 10 seconds
 # * At least 5 moves played by both sides
-def was_time_scramble(game):
-    scramble_regex = r'%clk 0:00:0[0-9](?:\.[0-9])?[^%]*%clk 0:00:0[0-9](?:\.[0-9])?'
-    return len(re.findall(scramble_regex, str(game))) >= 5
-
-def main(arguments):
-    username = arguments['USERNAME']
-    num_games = int(arguments['--num_games'])
-    threshold = int(arguments['--threshold'])
+def was_time_scramble(game, timeline=None):
+    if timeline is None:
+        timeline = clocks.ClockTimeline.from_game(game)
+    return timeline.was_scramble(100)
+
+def new_totals():
+    return {
+        'perf': stats.Moments(), 'scramble_perf': stats.Moments(),
+        'think': stats.Moments(), 'premoves': stats.Rate(), 'think_quantiles': stats.QuantileSketch(),
+        'scramble_think': stats.Moments(), 'scramble_premoves': stats.Rate(),
+    }
+
+def add_game(totals, game, username):
+    """Adds one game to totals. Returns False for games outside the analysis (not one minute standard chess)."""
+    if not is_normal_chess(game) or game.headers["TimeControl"] not in ("60", "30") or not is_60sec(game):
+        return False
+    with profiling.stage('analysis'):
+        think_times, scramble_times = get_think_times(game, username)
+        perf = get_user_perf(game, username)
+        totals['perf'].add(perf)
 
-    pgnfile = f'{username}.pgn'
-    if os.path.exists(pgnfile):
-        os.remove(pgnfile)
-    print(f'Downloading {pgnfile}...')
-    gamegrab.main({'USERNAME': username, '--time-class': 'bullet', '--outfile': pgnfile, '--color': None, '--since': '202001'})
+        for x in think_times:
+            totals['think'].add(x)
+            totals['premoves'].add(x == 1)
+            totals['think_quantiles'].add(x)
 
-    print('Analyzing games...', flush=True)
+        # delete scramble if not enough moves?
+        if len(scramble_times) >=4:
+            for x in scramble_times:
+                totals['scramble_think'].add(x)
+                totals['scramble_premoves'].add(x == 1)
+            totals['scramble_perf'].add(perf)
+    return True
 
-    no_long_think_perfs = []
-    long_think_perfs = []
+def analyze_games(games, username, progress=False):
+    totals = new_totals()
 
-    scramble_perfs = []
-    total_perfs = []
+    for game in profiling.timed(games, 'pgn parse'):
+        if not add_game(totals, game, username):
+            continue
+        profiling.progress('games')
 
-    think_moves, total_moves = 0, 0
+        if progress and totals['perf'].count % 100 == 0:
+            print(f'[{datetime.datetime.now()}] {totals["perf"].count} games complete.')
 
-    pgn = open(pgnfile)
-    think_times_n, total_think, total_premoves = 0, 0, 0
-    scramble_thinks_n, scramble_total_think, scramble_premoves = 0, 0, 0
+    return totals
 
-    game_count = 0
-    while game := chess.pgn.read_game(pgn):
-        if not is_normal_chess(game) or game.headers["TimeControl"] not in ("60", "30") or not is_60sec(game):
-            continue
-        think_times, scramble_times = get_think_times(game, username)
-        perf = get_user_perf(game, username)
-        total_perfs.append(perf)
+def get_entries(pgnfile, num_games):
+    # The index lets us read only the most recent one minute games
+    return [entry for entry in pgnio.update_index(pgnfile) if entry.headers['TimeControl'] == '60'][:num_games]
 
-        think_times_n += len(think_times)
-        total_think += sum(think_times)
-        total_premoves += sum(x for x in think_times if x==1)
+def analyze_chunk(args):
+    pgnfile, entries, username = args
+    return analyze_games(pgnio.iter_indexed(pgnfile, entries), username)
 
-        # delete scramble if not enough moves?
-        if len(scramble_times) >=4:
-            scramble_thinks_n += len(scramble_times)
-            scramble_total_think += sum(scramble_times)
-            scramble_premoves += sum(x for x in scramble_times if x==1)
-            scramble_perfs.append(perf)
+def main(arguments):
+    username = arguments['USERNAME']
+    num_games = int(arguments['--num_games'])
+    threshold = int(arguments['--threshold'])
+    store = arguments.get('--store')
+    jobs = int(arguments.get('--jobs') or 1)
+    load_stats = arguments.get('--load-stats')
+    save_stats = arguments.get('--save-stats')
 
-        game_count += 1
+    if not store:
+        pgnfile = pgnio.find_pgn(f'{username}.pgn')
+        print(f'Downloading {pgnfile}...')
+        gamegrab.main({'USERNAME': username, '--time-class': 'bullet', '--outfile': pgnfile, '--color': None, '--since': '202001', '--cache-dir': archivecache.DEFAULT_CACHE_DIR})
 
-        if game_count % 100 == 0:
-            print(f'[{datetime.datetime.now()}] {game_count} games complete.')
+    print('Analyzing games...', flush=True)
 
+    entries = None if store else get_entries(pgnfile, num_games)
+    if store:
+        totals = analyze_games(gamestore.query(store, time_controls=('60',), since='202001', limit=num_games), username, progress=True)
+    elif jobs > 1 and entries:
+        # Accumulators merge exactly, so chunk results combine into the serial totals
+        size = -(-len(entries) // jobs)
+        chunks = [(pgnfile, entries[i:i + size], username) for i in range(0, len(entries), size)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            totals = stats.merge_all(executor.map(analyze_chunk, chunks))
+        profiling.add('games', totals['perf'].count)
+    else:
+        totals = analyze_games(pgnio.iter_indexed(pgnfile, entries), username, progress=True)
+
+    if load_stats:
+        totals = stats.merge_all([totals, stats.load(load_stats)])
+    if save_stats:
+        stats.save(save_stats, totals)
+
+    quantiles = totals['think_quantiles']
     print(f'{username}')
     print('='*len(username))
-    print(f'n: {game_count}')
-    print(f'Total thinks: avg={0.1*total_think/think_times_n:.2f} sec, premove rate={100*total_premoves/think_times_n:.2f}%')
-    print(f'Scramble thinks: avg={0.1*scramble_total_think/scramble_thinks_n:.2f} sec premove rate={100*scramble_premoves/scramble_thinks_n:.2f}%')
+    print(f'n: {totals["perf"].count}')
+    print(f'Total thinks: avg={0.1*totals["think"].mean:.2f} sec, premove rate={100*totals["premoves"].rate:.2f}%')
+    print(f'Think time quantiles: p50={0.1*quantiles.quantile(0.5):.1f} sec, p90={0.1*quantiles.quantile(0.9):.1f} sec, p99={0.1*quantiles.quantile(0.99):.1f} sec')
+    print(f'Scramble thinks: avg={0.1*totals["scramble_think"].mean:.2f} sec premove rate={100*totals["scramble_premoves"].rate:.2f}%')
 
-    print(f'Perf in time scrambles: {int(sum(scramble_perfs)/len(scramble_perfs))}')
-    print(f'Overall perf: {int(sum(total_perfs) / len(total_perfs))}')
+    print(f'Perf in time scrambles: {int(totals["scramble_perf"].mean)}')
+    print(f'Overall perf: {int(totals["perf"].mean)}')
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
-    main(arguments)
+    with profiling.session(arguments):
+        main(arguments)
@@ -0,0 +1,205 @@
+"""watch
+Keeps a user's PGN and statistics up to date as new games are played, instead of recomputing everything on a schedule.
+
+Polls the archives of months that can still change, appends games not seen before (by Link) to the PGN and
+updates the saved aggregates in place: the timestats totals (OUTFILE.stats.json, in stats.save format), and the
+rolling rating series (OUTFILE.ratings.csv, one row per game). A restart picks up from the saved state. If the
+PGN was changed by anything else in the meantime, the state is rebuilt from the PGN.
+
+Usage:
+  watch.py [--outfile=OUTFILE] [--time-class=TC] [--color=COLOR] [--interval=SEC] [--moving-avg=N] [--cache-dir=DIR] [--base-url=URL] [--once] [--profile] [--trace=FILE] USERNAME
+  watch.py (-h | --help)
+
+Options:
+  --outfile=OUTFILE     PGN to keep up to date (defaults to USERNAME.pgn), downloaded first if missing.
+  --time-class=TC       Only keep games of specified time control.
+  --color=COLOR         Only keep games of specific color.
+  --interval=SEC        Seconds between polls (default 60).
+  --moving-avg=N        Games in the rolling rating average (default 500).
+  --cache-dir=DIR       Archive cache, so unchanged months cost a conditional request (default .gamegrab_cache).
+  --base-url=URL        Use another chess.com API host, e.g. a local mockchesscom.py server.
+  --once                Poll once and exit.
+  --profile             Report time per stage, throughput and cache hit rates when done.
+  --trace=FILE          Also write a Chrome trace event JSON of the run to FILE.
+  -h --help             Show this screen.
+
+Arguments:
+  USERNAME      username to watch
+"""
+
+from archivecache import ArchiveCache
+from docopt import docopt
+
+import archivecache
+import clocks
+import datetime
+import gamegrab
+import graph
+import io
+import json
+import os
+import pgnio
+import profiling
+import records
+import stats
+import time
+import timestats
+
+DEFAULT_INTERVAL = 60
+DEFAULT_MOVING_AVG = 500
+
+
+def state_paths(outfile):
+    return f'{outfile}.watch.json', f'{outfile}.stats.json', f'{outfile}.ratings.csv'
+
+def open_months(urls, now):
+    """Archive urls of months that can still gain games (see archivecache.ARCHIVE_GRACE)."""
+    return [url for url in urls if not archivecache.month_is_final(url, now)]
+
+def game_date(game):
+    return game.headers.get('EndDate') or game.headers.get('UTCDate', '')
+
+def user_rating(game, username):
+    return int(game.headers['WhiteElo'] if timestats.is_user_white(game, username) else game.headers['BlackElo'])
+
+
+class Watcher:
+    """Saved state of one watched PGN: the links of recent games, the totals and the rolling rating window."""
+
+    def __init__(self, outfile, username, moving_avg=DEFAULT_MOVING_AVG):
+        self.outfile = outfile
+        self.username = username
+        self.moving_avg = moving_avg
+        self.state_path, self.stats_path, self.ratings_path = state_paths(outfile)
+        self.state = None
+        self.totals = None
+
+    def load(self):
+        """Loads the saved state, or rebuilds it if it is missing or does not match the PGN."""
+        if os.path.exists(self.state_path) and os.path.exists(self.stats_path):
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state['pgn_size'] == os.path.getsize(self.outfile) and state['moving_avg'] == self.moving_avg:
+                self.state, self.totals = state, stats.load(self.stats_path)
+                return False
+        self.rebuild()
+        return True
+
+    def rebuild(self):
+        print(f'Building statistics from {self.outfile}...', flush=True)
+        self.totals = timestats.analyze_games(pgnio.scan_pgn(self.outfile), self.username)
+        # Games that can still appear in a poll are the ones from last month on
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        since = (today.replace(day=1) - datetime.timedelta(days=1)).strftime('%Y.%m.01')
+        seen = {}
+        games = records.GameRecords.from_games(self.scan_recent(seen, since), self.username)
+
+        history = graph.rating_history(games, self.moving_avg)
+        with open(self.ratings_path, 'w') as f:
+            f.write('date,time,rating,avg\n')
+            for t, rating, avg in zip(history['time'], history['rating'], history['avg']):
+                f.write(f'{t:%Y.%m.%d,%H:%M:%S},{rating},{avg}\n')
+        self.state = {'pgn_size': 0, 'moving_avg': self.moving_avg, 'seen': seen,
+                      'window': [int(rating) for rating in history['rating'].iloc[-self.moving_avg:]]}
+        self.save()
+
+    def scan_recent(self, seen, since):
+        """Yields every game of the PGN, recording the links of those played since (YYYY.MM.DD) in seen."""
+        for game in pgnio.scan_pgn(self.outfile):
+            if game_date(game) >= since and 'Link' in game.headers:
+                seen[game.headers['Link']] = game_date(game)
+            yield game
+
+    def save(self):
+        stats.save(self.stats_path, self.totals)
+        self.state['pgn_size'] = os.path.getsize(self.outfile)
+        archivecache.write_atomic(self.state_path, json.dumps(self.state).encode())
+
+    def add_games(self, pgns):
+        """Appends new games (oldest first) to the PGN and updates every aggregate with them."""
+        with pgnio.open_pgn(self.outfile, 'a') as f:
+            for pgn in pgns:
+                f.write(pgn)
+                f.write('\n')
+        window = self.state['window']
+        with open(self.ratings_path, 'a') as ratings:
+            for pgn in pgns:
+                for game in clocks.scan_games(io.BytesIO(pgn.encode())):
+                    timestats.add_game(self.totals, game, self.username)
+                    self.state['seen'][game.headers.get('Link', '')] = game_date(game)
+                    window.append(user_rating(game, self.username))
+                    del window[:-self.moving_avg]
+                    avg = sum(window) // self.moving_avg if len(window) == self.moving_avg else 0
+                    ratings.write(f'{game.headers.get("UTCDate")},{game.headers.get("UTCTime")},{window[-1]},{avg}\n')
+        self.save()
+
+    def prune(self, since):
+        self.state['seen'] = {link: date for link, date in self.state['seen'].items() if date >= since}
+
+    def poll(self, session, base_url, wanted, cache):
+        """Downloads the open months and adds their new games. Returns how many were added."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        urls = gamegrab.fetch_json(session, gamegrab.archives_url(self.username, base_url), cache)['archives']
+        months = open_months(urls, now)
+        new = []
+        for url in months:
+            for game in gamegrab.fetch_games(session, url, cache):
+                if wanted(game) and game['url'] not in self.state['seen']:
+                    new.append(game)
+        if months:
+            year, month = archivecache.month_of(months[0])
+            self.prune(f'{year:04}.{month:02}.01')
+        new.sort(key=lambda game: game.get('end_time', 0))
+        if new:
+            self.add_games([game['pgn'] for game in new])
+        return len(new)
+
+    def print_summary(self):
+        totals = self.totals
+        window = self.state['window']
+        print(f'  n: {totals["perf"].count}, overall perf: {totals["perf"].mean:.0f}, perf in time scrambles: {totals["scramble_perf"].mean:.0f}')
+        print(f'  thinks: avg={0.1*totals["think"].mean:.2f} sec, premove rate={100*totals["premoves"].rate:.2f}%')
+        if len(window) == self.moving_avg:
+            print(f'  {self.moving_avg}-game rating average: {sum(window) // self.moving_avg}')
+        print(flush=True)
+
+
+def main(arguments):
+    user = arguments['USERNAME']
+    outfile = arguments.get('--outfile') or f'{user}.pgn'
+    time_class = arguments.get('--time-class')
+    color = arguments['--color'].lower() if arguments.get('--color') else None
+    interval = float(arguments.get('--interval') or DEFAULT_INTERVAL)
+    moving_avg = int(arguments.get('--moving-avg') or DEFAULT_MOVING_AVG)
+    cache_dir = arguments.get('--cache-dir') or archivecache.DEFAULT_CACHE_DIR
+    base_url = arguments.get('--base-url') or gamegrab.API_URL
+
+    if not os.path.exists(outfile):
+        gamegrab.main({'USERNAME': user, '--outfile': outfile, '--time-class': time_class, '--color': color,
+                       '--cache-dir': cache_dir, '--base-url': base_url})
+
+    watcher = Watcher(outfile, user, moving_avg)
+    if watcher.load():
+        watcher.print_summary()
+    session = gamegrab.make_session()
+    cache = ArchiveCache(cache_dir)
+    wanted = gamegrab.game_filter(user, time_class, color)
+    while True:
+        start = time.perf_counter()
+        try:
+            added = watcher.poll(session, base_url, wanted, cache)
+        except Exception as e:
+            # A failed poll (network, 429, ...) is retried on the next one
+            print(f'[{datetime.datetime.now():%H:%M:%S}] Poll failed: {e}', flush=True)
+            added = 0
+        if added:
+            print(f'[{datetime.datetime.now():%H:%M:%S}] {added} new games, updated in {1000 * (time.perf_counter() - start):.0f} ms')
+            watcher.print_summary()
+        if arguments.get('--once'):
+            return watcher
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    with profiling.session(arguments):
+        main(arguments)